@@ -1,8 +1,8 @@
-from fastapi import FastAPI, File, UploadFile, Request
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, UploadFile, Request, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from motor.motor_asyncio import AsyncIOMotorClient
+from pydantic import BaseModel, ValidationError
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
 from dotenv import load_dotenv
 # import google.generativeai as genai # Removed as per edit hint
 import json
@@ -11,7 +11,8 @@ import ollama
 from typing import Dict, Callable, TypedDict
 from langchain_ollama import OllamaLLM
 # from ti import get_date # Assuming ti.py exists and is accessible
-from pymongo import MongoClient
+from pymongo import monitoring, IndexModel, ASCENDING, DESCENDING, TEXT, UpdateOne, ReturnDocument
+from pymongo.errors import PyMongoError, BulkWriteError, DuplicateKeyError
 import ast
 import logging
 from langgraph.graph import StateGraph, END
@@ -19,6 +20,18 @@ import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import asyncio
+import csv
+import datetime
+import hashlib
+import httpx
+import io
+import random
+import re
+import tempfile
+import time
+import uuid
+from contextlib import asynccontextmanager
+from cachetools import TTLCache, LRUCache
 
 # logging.basicConfig(level=logging.DEBUG)
 # logging.getLogger("pymongo").setLevel(logging.DEBUG)
@@ -26,13 +39,78 @@ import asyncio
 # Load environment variables from .env file
 load_dotenv()
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    watcher = asyncio.create_task(watch_leads())
+    # Index builds can take a while on big collections, and Mongo may be down,
+    # so none of the setup steps hold up startup
+    setup_tasks = [
+        asyncio.create_task(ensure_lead_indexes()),
+        asyncio.create_task(ensure_extract_job_indexes()),
+        asyncio.create_task(ensure_idempotency_index()),
+    ]
+    job_workers = start_extract_job_workers()
+    yield
+    watcher.cancel()
+    for task in setup_tasks:
+        task.cancel()
+    # Jobs that were running are picked up again once their lease expires
+    for worker in job_workers:
+        worker.cancel()
+    if save_lead_coalescer is not None:
+        await save_lead_coalescer.drain()
+    # Release pooled connections on shutdown
+    await ollama_transport.aclose()
+
+app = FastAPI(lifespan=lifespan)
+
+# 📦 Upload limits, enforced by the middleware below and checked again per file
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_MAX_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_REQUEST_BYTES", str(200 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+class UploadTooLarge(HTTPException):
+    # Raised while the body is still being read, answered like every other error response
+    def __init__(self, message):
+        super().__init__(status_code=413, detail=message)
+
+@app.exception_handler(UploadTooLarge)
+async def upload_too_large_handler(request: Request, exc: UploadTooLarge):
+    return JSONResponse(content={"error": exc.detail}, status_code=413)
+
+class UploadSizeLimitMiddleware:
+    # Rejects oversized upload bodies while they stream in, before they are fully spooled
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith("/extract"):
+            return await self.app(scope, receive, send)
+        # A single upload may carry a little multipart framing on top of the file itself
+        limit = UPLOAD_MAX_REQUEST_BYTES if scope["path"] != "/extract" else UPLOAD_MAX_BYTES + UPLOAD_CHUNK_SIZE
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > limit:
+            response = JSONResponse(content={"error": f"Request body is larger than {limit} bytes"}, status_code=413)
+            return await response(scope, receive, send)
+
+        received = 0
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise UploadTooLarge(f"Request body is larger than {limit} bytes")
+            return message
+
+        await self.app(scope, limited_receive, send)
 
 origins = [
     "http://localhost:5173",  # Allow your frontend origin
     "http://localhost:8000",  # Allow your backend origin if needed
 ]
 
+app.add_middleware(UploadSizeLimitMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -46,25 +124,218 @@ MONGO_DETAILS = os.getenv("MONGO_DETAILS")
 if not MONGO_DETAILS:
     raise ValueError("MONGO_DETAILS environment variable not set.")
 
-client = AsyncIOMotorClient(MONGO_DETAILS)
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "5"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "20000"))
+# Server-side time limit for queries issued by chat tools
+MONGO_MAX_TIME_MS = int(os.getenv("MONGO_MAX_TIME_MS", "2000"))
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self.counts = {
+            "connections_created": 0,
+            "connections_closed": 0,
+            "checkouts": 0,
+            "checkout_failures": 0,
+            "checked_out": 0,
+            "pool_clears": 0,
+        }
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.counts["pool_clears"] += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.counts["connections_created"] += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.counts["connections_closed"] += 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self.counts["checkout_failures"] += 1
+
+    def connection_checked_out(self, event):
+        self.counts["checkouts"] += 1
+        self.counts["checked_out"] += 1
+
+    def connection_checked_in(self, event):
+        self.counts["checked_out"] -= 1
+
+    def snapshot(self):
+        return {
+            **self.counts,
+            "open_connections": self.counts["connections_created"] - self.counts["connections_closed"],
+            "max_pool_size": MONGO_MAX_POOL_SIZE,
+            "min_pool_size": MONGO_MIN_POOL_SIZE,
+        }
+
+pool_metrics = PoolMetrics()
+
+client = AsyncIOMotorClient(
+    MONGO_DETAILS,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+    serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+    event_listeners=[pool_metrics],
+)
 database = client.test
 leads_collection = database.get_collection("leads")
+extraction_cache_collection = database.get_collection("extraction_cache")
+extract_jobs_collection = database.get_collection("extract_jobs")
+idempotency_collection = database.get_collection("idempotency_keys")
+# Job uploads are kept in GridFS until the job has finished
+upload_bucket = AsyncIOMotorGridFSBucket(database, bucket_name="extract_uploads")
+
+# 🗂 Indexes the backend relies on, reconciled at startup
+LEAD_INDEXES = [
+    # Chat filters on status, workflow and date questions sort by createdAt
+    IndexModel([("status", ASCENDING), ("createdAt", DESCENDING)], name="status_1_createdAt_-1"),
+    IndexModel([("createdAt", DESCENDING)], name="createdAt_-1"),
+    IndexModel([("source", ASCENDING)], name="source_1"),
+    # Same name and spec as the unique index declared in models/Lead.js
+    IndexModel([("email", ASCENDING)], name="email_1", unique=True),
+    # Case-insensitive name lookups, see CASE_INSENSITIVE_COLLATION
+    IndexModel([("name", ASCENDING)], name="name_ci", collation={"locale": "en", "strength": 2}),
+    IndexModel([("name", TEXT), ("email", TEXT), ("source", TEXT)], name="lead_text"),
+]
+index_status = {"state": "pending", "created": [], "existing": [], "failed": {}}
+
+async def ensure_lead_indexes():
+    try:
+        existing = await leads_collection.index_information()
+        index_status["state"] = "building"
+        for index in LEAD_INDEXES:
+            name = index.document["name"]
+            if name in existing:
+                index_status["existing"].append(name)
+                continue
+            # One at a time so a single conflict does not stop the others
+            try:
+                await leads_collection.create_indexes([index])
+                index_status["created"].append(name)
+                print(f"🗂 Created index {name}")
+            except PyMongoError as e:
+                index_status["failed"][name] = str(e)
+                print(f"❌ Could not create index {name}: {e}")
+        index_status["state"] = "ready"
+    except PyMongoError as e:
+        index_status["state"] = "error"
+        index_status["failed"]["*"] = str(e)
+        print(f"❌ Index provisioning failed: {e}")
+
+async def index_report():
+    declared = {index.document["name"] for index in LEAD_INDEXES}
+    usage = await leads_collection.aggregate([{"$indexStats": {}}]).to_list(length=None)
+    builds = await client.admin.aggregate([
+        {"$currentOp": {"allUsers": True}},
+        {"$match": {"command.createIndexes": leads_collection.name}},
+    ]).to_list(length=None)
+    return {
+        **index_status,
+        "in_progress": [
+            {"indexes": [spec.get("name") for spec in op["command"].get("indexes", [])], "progress": op.get("progress")}
+            for op in builds
+        ],
+        "usage": {stat["name"]: stat["accesses"]["ops"] for stat in usage},
+        # Indexes that no query has used since the server started tracking
+        "unused": sorted(stat["name"] for stat in usage if stat["accesses"]["ops"] == 0 and stat["name"] != "_id_"),
+        "undeclared": sorted(stat["name"] for stat in usage if stat["name"] not in declared and stat["name"] != "_id_"),
+    }
 
 # Initialize Gemini
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if not GEMINI_API_KEY:
     raise ValueError("GEMINI_API_KEY environment variable not set.")
 
+# Optional: PDF text layer extraction for the local /extract fast path
+try:
+    from pypdf import PdfReader, PdfWriter
+except ImportError:
+    PdfReader = PdfWriter = None
+
+# Optional: image downscaling before model upload
+try:
+    from PIL import Image, ImageChops, ImageOps
+except ImportError:
+    Image = None
+
 # Uncomment Gemini imports and model setup for document extraction
 import google.generativeai as genai
 # Restore Gemini model setup
 genai.configure(api_key=GEMINI_API_KEY)
 model = genai.GenerativeModel('gemini-1.5-flash')
 
-class LeadData(BaseModel):
+# Ollama connection (one pooled async client shared by every chat request)
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "crm")
+# Keep this in line with OLLAMA_NUM_PARALLEL on the model server
+OLLAMA_MAX_CONCURRENCY = int(os.getenv("OLLAMA_MAX_CONCURRENCY", "4"))
+OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "120"))
+
+# The connection pool lives in our own transport so it can be closed on shutdown
+ollama_transport = httpx.AsyncHTTPTransport(
+    limits=httpx.Limits(
+        max_connections=OLLAMA_MAX_CONCURRENCY * 2,
+        max_keepalive_connections=OLLAMA_MAX_CONCURRENCY,
+    ),
+)
+ollama_client = ollama.AsyncClient(
+    host=OLLAMA_HOST,
+    timeout=OLLAMA_TIMEOUT,
+    transport=ollama_transport,
+)
+ollama_semaphore = asyncio.Semaphore(OLLAMA_MAX_CONCURRENCY)
+
+async def chat_llm(messages, tools=None):
+    # Wait for a free model slot instead of queueing inside the Ollama server
+    async with ollama_semaphore:
+        return await ollama_client.chat(
+            model=OLLAMA_MODEL,
+            messages=messages,
+            tools=tools,
+            stream=False
+        )
+
+async def stream_llm(messages, tools=None):
+    # The model slot is held until the whole answer has been streamed
+    async with ollama_semaphore:
+        async for chunk in await ollama_client.chat(
+            model=OLLAMA_MODEL,
+            messages=messages,
+            tools=tools,
+            stream=True
+        ):
+            yield chunk
+
+class ExtractedLead(BaseModel):
+    # Response schema for document extraction
     name: str
     email: str
     phone: str
+
+class ExtractedLeadList(BaseModel):
+    # Response schema for documents listing several people
+    leads: list[ExtractedLead]
+
+class LeadData(ExtractedLead):
     source: str = "document/image" # Default source
 
 from typing import Optional # Import Optional
@@ -72,23 +343,316 @@ from typing import Optional # Import Optional
 class PromptInput(BaseModel):
     user_input: str
     lead_data: Optional[Dict] = None # Add optional lead_data field
+    llm_summary: bool = False # Force the model to phrase tool results
 
-def get_data(query):
+LEAD_FIELDS = ["name", "email", "phone", "status", "source", "createdAt", "dateContacted"]
+DATE_BUCKET_FORMATS = {
+    "day": "%Y-%m-%d",
+    "week": "%G-W%V",
+    "month": "%Y-%m",
+    "year": "%Y",
+}
+STATS_MAX_GROUPS = int(os.getenv("STATS_MAX_GROUPS", "20"))
+
+def parse_query(query):
     # 🧠 Convert to dict only if it's a string
     if isinstance(query, str):
         print(query)
         query = ast.literal_eval(query)
         print(query)
-    elif not isinstance(query, dict):
-        return {"error": f"Query must be a dict or string representing a dict, not {type(query)._name_}"}
+    return query
+
+# 🧮 Canonical form of model-generated filters, so equivalent queries share a cache entry
+REGEX_META = set(".^$*+?()[]{}|\\")
+
+def literal_regex(pattern):
+    # Returns the literal text of an anchored regex like ^Akshaj$, otherwise None
+    if len(pattern) >= 2 and pattern.startswith("^") and pattern.endswith("$"):
+        body = pattern[1:-1]
+        if not any(ch in REGEX_META for ch in body):
+            return body
+    return None
+
+def canonicalize_condition(condition):
+    if not isinstance(condition, dict):
+        return condition
+    if set(condition) == {"$eq"}:
+        return condition["$eq"]
+    if set(condition) == {"$in"} and isinstance(condition["$in"], list) and len(condition["$in"]) == 1:
+        return condition["$in"][0]
+    if "$regex" in condition and isinstance(condition["$regex"], str):
+        condition = dict(condition)
+        options = "".join(sorted(set(condition.pop("$options", "") or "")))
+        pattern = condition["$regex"]
+        is_literal = not any(ch in REGEX_META for ch in pattern.lstrip("^").rstrip("$"))
+        if not options and len(condition) == 1 and literal_regex(pattern) is not None:
+            return literal_regex(pattern)
+        if "i" in options and is_literal:
+            # Case-insensitive literal patterns match the same documents in any case
+            condition["$regex"] = pattern.lower()
+        if options:
+            condition["$options"] = options
+    if isinstance(condition.get("$in"), list):
+        condition = {**condition, "$in": sorted(condition["$in"], key=lambda item: json.dumps(item, sort_keys=True, default=str))}
+    return {key: condition[key] for key in sorted(condition)}
+
+def canonicalize_query(query):
+    if isinstance(query, list):
+        return [canonicalize_query(item) for item in query]
+    if not isinstance(query, dict):
+        return query
+    canonical = {}
+    for key in sorted(query):
+        if key in ("$and", "$or") and isinstance(query[key], list):
+            clauses = [canonicalize_query(clause) for clause in query[key]]
+            # A single clause is the same as no wrapper at all
+            if len(clauses) == 1 and isinstance(clauses[0], dict) and not set(clauses[0]) & set(query):
+                canonical.update(clauses[0])
+                continue
+            canonical[key] = sorted(clauses, key=lambda clause: json.dumps(clause, sort_keys=True, default=str))
+        elif key.startswith("$"):
+            canonical[key] = canonicalize_query(query[key])
+        else:
+            canonical[key] = canonicalize_condition(canonicalize_query(query[key]))
+    return {key: canonical[key] for key in sorted(canonical)}
+
+# 🛡 Query compiler: validates model filters against the lead schema and rewrites them into index-friendly forms
+QUERY_ROW_LIMIT = int(os.getenv("QUERY_ROW_LIMIT", "500"))
+DATE_FIELDS = ("createdAt", "dateContacted")
+FIELD_OPERATORS = {"$eq", "$ne", "$gt", "$gte", "$lt", "$lte", "$in", "$nin", "$exists", "$regex", "$options"}
+LOGICAL_OPERATORS = {"$and", "$or", "$nor"}
+# Must match the collation of the name index
+CASE_INSENSITIVE_COLLATION = {"locale": "en", "strength": 2}
+
+class QueryError(ValueError):
+    pass
+
+def parse_date(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, str):
+        try:
+            return datetime.datetime.fromisoformat(value.strip())
+        except ValueError:
+            pass
+    raise QueryError(f"Invalid date {value!r}, use an ISO datetime string like 2025-07-01T00:00:00")
+
+def compile_date_condition(field, condition):
+    if not isinstance(condition, dict):
+        # A bare day matches the whole day, not just midnight
+        if isinstance(condition, str) and len(condition.strip()) == 10:
+            day = parse_date(condition)
+            return {"$gte": day, "$lt": day + datetime.timedelta(days=1)}
+        return parse_date(condition)
+    compiled = {}
+    for op, value in condition.items():
+        if op not in FIELD_OPERATORS:
+            raise QueryError(f"Unsupported operator {op} on {field}")
+        if op in ("$regex", "$options"):
+            raise QueryError(f"{field} is a date, use $gte/$lt ranges instead of $regex")
+        if op in ("$in", "$nin"):
+            compiled[op] = [parse_date(item) for item in value]
+        elif op == "$exists":
+            compiled[op] = bool(value)
+        else:
+            compiled[op] = parse_date(value)
+    return compiled
+
+def compile_condition(field, condition, state):
+    if field in DATE_FIELDS:
+        return compile_date_condition(field, condition)
+    if not isinstance(condition, dict):
+        if isinstance(condition, (list, tuple)):
+            raise QueryError(f"Use $in to match {field} against several values")
+        if isinstance(condition, str):
+            state["collation_sensitive"] = True
+        return condition
+    compiled = {}
+    for op, value in condition.items():
+        if op not in FIELD_OPERATORS:
+            raise QueryError(f"Unsupported operator {op} on {field}")
+        if op in ("$in", "$nin") and not isinstance(value, list):
+            raise QueryError(f"{op} on {field} needs a list")
+        if op == "$regex" and not isinstance(value, str):
+            raise QueryError(f"$regex on {field} needs a string pattern")
+        compiled[op] = value
+
+    if is_exact_name_match(field, compiled):
+        state["exact_names"] += 1
+        if state["rewrite_names"]:
+            # Exact case-insensitive match: plain equality under the name index collation
+            return literal_regex(compiled["$regex"])
+    elif any(is_collation_sensitive(op, value) for op, value in compiled.items()):
+        state["collation_sensitive"] = True
+    return compiled
+
+def is_exact_name_match(field, condition):
+    return (
+        field == "name"
+        and set(condition) == {"$regex", "$options"}
+        and condition["$options"] == "i"
+        and literal_regex(condition["$regex"]) is not None
+    )
+
+def is_collation_sensitive(op, value):
+    # String comparisons change meaning under a collation, regexes and non-string values do not
+    if op in ("$regex", "$options", "$exists"):
+        return False
+    if isinstance(value, list):
+        return any(isinstance(item, str) for item in value)
+    return isinstance(value, str)
+
+def compile_clause(query, state):
+    if not isinstance(query, dict):
+        raise QueryError(f"Query must be a dict, not {type(query).__name__}")
+    compiled = {}
+    for key, value in query.items():
+        if key in LOGICAL_OPERATORS:
+            if not isinstance(value, list) or not value:
+                raise QueryError(f"{key} needs a non-empty list of conditions")
+            compiled[key] = [compile_clause(clause, state) for clause in value]
+        elif key.startswith("$"):
+            raise QueryError(f"Unsupported operator {key}")
+        elif key not in LEAD_FIELDS:
+            raise QueryError(f"Unknown field {key}, use one of {LEAD_FIELDS}")
+        else:
+            compiled[key] = compile_condition(key, value, state)
+    return compiled
+
+def compile_query(query):
+    # Returns the rewritten filter and the collation it has to run with.
+    # The collation applies to the whole filter, so exact name matches only become
+    # collated equality when no other string comparison would turn case-insensitive
+    # with them (and lose the simple-collation status/source indexes).
+    query = canonicalize_query(query)
+    state = {"rewrite_names": False, "exact_names": 0, "collation_sensitive": False}
+    compiled = compile_clause(query, state)
+    if not state["exact_names"] or state["collation_sensitive"]:
+        return compiled, None
+    state["rewrite_names"] = True
+    return compile_clause(query, state), CASE_INSENSITIVE_COLLATION
+
+# 🔬 Sampled explain() of tool queries, grouped by query shape
+EXPLAIN_SAMPLE_RATE = float(os.getenv("EXPLAIN_SAMPLE_RATE", "0.1"))
+# Model filters are free-form, so only the most recently seen shapes are kept
+QUERY_SHAPES_MAX = int(os.getenv("QUERY_SHAPES_MAX", "256"))
+query_shapes = LRUCache(maxsize=QUERY_SHAPES_MAX)
+# Strong references to running explains, the event loop only keeps weak ones
+explain_tasks = set()
 
-    # ✅ Now query is a dictionary
-    client = MongoClient("mongodb://localhost:27017/")
-    db = client["test"]
-    collection = db["leads"]
+def query_shape(query):
+    # Keep keys and operators, replace values with their type
+    if isinstance(query, dict):
+        return {key: query_shape(value) for key, value in sorted(query.items())}
+    if isinstance(query, list):
+        shapes = [query_shape(item) for item in query]
+        return shapes if any(isinstance(shape, (dict, list)) for shape in shapes) else [shapes[0]] if shapes else []
+    return type(query).__name__
 
-    results = collection.find(query, {"_id": 0})
-    print(results)
+def plan_stages(plan):
+    if not isinstance(plan, dict):
+        return []
+    stages = [plan["stage"]] if "stage" in plan else []
+    for child in [plan.get("inputStage"), plan.get("queryPlan"), *plan.get("inputStages", [])]:
+        stages += plan_stages(child)
+    return stages
+
+def summarize_explain(explain):
+    # Aggregations nest the find plan under their first $cursor stage
+    cursor_stage = next((stage["$cursor"] for stage in explain.get("stages", []) if "$cursor" in stage), {})
+    planner = explain.get("queryPlanner") or cursor_stage.get("queryPlanner", {})
+    stats = explain.get("executionStats") or cursor_stage.get("executionStats", {})
+    stages = plan_stages(planner.get("winningPlan", {}))
+    return {
+        "keys_examined": stats.get("totalKeysExamined", 0),
+        "docs_examined": stats.get("totalDocsExamined", 0),
+        "returned": stats.get("nReturned", 0),
+        "duration_ms": stats.get("executionTimeMillis", 0),
+        "winning_plan": stages,
+        "collscan": "COLLSCAN" in stages,
+    }
+
+async def record_explain(kind, filter, command):
+    try:
+        explain = await database.command({"explain": command, "verbosity": "executionStats"})
+    except PyMongoError as e:
+        print(f"⚠ explain failed for {kind}: {e}")
+        return
+    summary = summarize_explain(explain)
+    shape = json.dumps(query_shape(filter), sort_keys=True)
+    entry = query_shapes.setdefault((kind, shape), {
+        "kind": kind, "shape": shape, "samples": 0, "total_ms": 0, "max_ms": 0,
+        "keys_examined": 0, "docs_examined": 0, "returned": 0, "collscans": 0,
+    })
+    entry["samples"] += 1
+    entry["total_ms"] += summary["duration_ms"]
+    entry["max_ms"] = max(entry["max_ms"], summary["duration_ms"])
+    for field in ("keys_examined", "docs_examined", "returned"):
+        entry[field] += summary[field]
+    entry["collscans"] += summary["collscan"]
+    entry["winning_plan"] = summary["winning_plan"]
+    entry["example"] = json.dumps(filter, default=str)
+
+def maybe_explain(kind, filter, command):
+    # Runs in the background so sampled requests are not slowed down
+    if EXPLAIN_SAMPLE_RATE > 0 and random.random() < EXPLAIN_SAMPLE_RATE:
+        task = asyncio.create_task(record_explain(kind, filter, command))
+        explain_tasks.add(task)
+        task.add_done_callback(explain_tasks.discard)
+
+def worst_query_shapes(limit=10):
+    ranked = sorted(
+        query_shapes.values(),
+        key=lambda entry: (entry["collscans"] > 0, entry["total_ms"] / entry["samples"], entry["docs_examined"] / entry["samples"]),
+        reverse=True,
+    )
+    return [
+        {
+            **entry,
+            "avg_ms": entry["total_ms"] / entry["samples"],
+            # Docs read per doc returned, 1 is ideal
+            "docs_examined_per_returned": entry["docs_examined"] / max(entry["returned"], 1),
+            "collscan": entry["collscans"] > 0,
+        }
+        for entry in ranked[:limit]
+    ]
+
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "512"))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "30"))
+# Entries are tagged with leads_version and ignored once the collection has been written to.
+# Without a change stream (standalone mongod) writes from the Node.js server are not seen,
+# so the TTL bounds how long such rows can be served stale.
+query_cache = TTLCache(maxsize=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL)
+query_cache_stats = {"hits": 0, "misses": 0}
+
+async def get_data(query, fields=None):
+    try:
+        query, collation = compile_query(parse_query(query))
+    except (ValueError, SyntaxError) as e:
+        return {"error": f"Invalid query: {e}"}
+
+    # Only project the lead fields the answer needs
+    projection = {field: 1 for field in (fields or LEAD_FIELDS) if field in LEAD_FIELDS} or {field: 1 for field in LEAD_FIELDS}
+    projection["_id"] = 0
+
+    cache_key = (json.dumps([query, collation], sort_keys=True, default=str), tuple(sorted(projection)))
+    cached = query_cache.get(cache_key)
+    if cached is not None and cached[0] == leads_version:
+        query_cache_stats["hits"] += 1
+        return list(cached[1])
+    query_cache_stats["misses"] += 1
+
+    # ✅ Now query is a dictionary, run it on the app's pooled client
+    version = leads_version
+    cursor = leads_collection.find(query, projection, collation=collation).max_time_ms(MONGO_MAX_TIME_MS).limit(QUERY_ROW_LIMIT)
+    results = await cursor.to_list(length=None)
+    print(f"🔎 get_data matched {len(results)} leads")
+    query_cache[cache_key] = (version, results)
+
+    find_command = {"find": leads_collection.name, "filter": query, "projection": projection, "limit": QUERY_ROW_LIMIT, "maxTimeMS": MONGO_MAX_TIME_MS}
+    if collation:
+        find_command["collation"] = collation
+    maybe_explain("get_the_mango", query, find_command)
     return list(results)
 
 # 🛠 Tool schema for get_data (MongoDB)
@@ -112,7 +676,128 @@ get_the_mango = {
 - createdAt (ISO datetime string)
 - dateContacted (ISO datetime string)
 ''',
-                }
+                },
+                'fields': {
+                    'type': 'array',
+                    'items': {'type': 'string', 'enum': LEAD_FIELDS},
+                    'description': 'Optional list of fields needed to answer, e.g. ["name", "email"]. Defaults to all lead fields.',
+                },
+                'all_rows': {
+                    'type': 'boolean',
+                    'description': 'Set to true only when the user needs every matching lead considered, not just a sample.',
+                },
+            },
+        },
+    },
+}
+
+async def get_stats(operation, match=None, group_by=None, date_field="createdAt", interval="day"):
+    # 📊 Aggregate inside MongoDB so the model only sees compact numbers
+    try:
+        match, collation = compile_query(parse_query(match) or {})
+    except (ValueError, SyntaxError) as e:
+        return {"error": f"Invalid match: {e}"}
+    aggregate_options = {"maxTimeMS": MONGO_MAX_TIME_MS}
+    if collation:
+        aggregate_options["collation"] = collation
+
+    pipeline = [{"$match": match}]
+    explain_command = {"aggregate": leads_collection.name, "pipeline": pipeline, "cursor": {}, **aggregate_options}
+    if operation == "count":
+        pipeline.append({"$count": "count"})
+        results = await leads_collection.aggregate(pipeline, **aggregate_options).to_list(length=1)
+        maybe_explain("get_the_stats", match, explain_command)
+        return {"count": results[0]["count"] if results else 0}
+
+    if operation == "group":
+        if group_by not in LEAD_FIELDS:
+            return {"error": f"group_by must be one of {LEAD_FIELDS}"}
+        pipeline += [
+            {"$group": {"_id": f"${group_by}", "count": {"$sum": 1}}},
+            # The total and the number of values are taken before only the top groups are kept
+            {"$facet": {
+                "groups": [
+                    {"$sort": {"count": -1}},
+                    {"$limit": STATS_MAX_GROUPS},
+                    {"$project": {"_id": 0, group_by: "$_id", "count": 1}},
+                ],
+                "summary": [{"$group": {"_id": None, "total": {"$sum": "$count"}, "values": {"$sum": 1}}}],
+            }},
+        ]
+    elif operation == "date_bucket":
+        if date_field not in ("createdAt", "dateContacted"):
+            return {"error": "date_field must be 'createdAt' or 'dateContacted'"}
+        if interval not in DATE_BUCKET_FORMATS:
+            return {"error": f"interval must be one of {list(DATE_BUCKET_FORMATS)}"}
+        # Older documents may hold ISO strings instead of dates
+        as_date = {"$convert": {"input": f"${date_field}", "to": "date", "onError": None, "onNull": None}}
+        pipeline += [
+            {"$group": {
+                "_id": {"$dateToString": {"format": DATE_BUCKET_FORMATS[interval], "date": as_date}},
+                "count": {"$sum": 1},
+            }},
+            # Like groups, only the latest periods are kept, the total covers all of them
+            {"$facet": {
+                "groups": [
+                    {"$sort": {"_id": -1}},
+                    {"$limit": STATS_MAX_GROUPS},
+                    {"$project": {"_id": 0, "period": "$_id", "count": 1}},
+                ],
+                "summary": [{"$group": {"_id": None, "total": {"$sum": "$count"}, "values": {"$sum": 1}}}],
+            }},
+        ]
+    else:
+        return {"error": "operation must be one of 'count', 'group' or 'date_bucket'"}
+
+    results = await leads_collection.aggregate(pipeline, **aggregate_options).to_list(length=1)
+    maybe_explain("get_the_stats", match, explain_command)
+    groups = results[0]["groups"] if results else []
+    summary = results[0]["summary"][0] if results and results[0]["summary"] else {"total": 0, "values": 0}
+    if operation == "date_bucket":
+        # Oldest period first
+        groups.reverse()
+    return {
+        "operation": operation,
+        "total": summary["total"],
+        "groups": groups,
+        "distinct_values": summary["values"],
+        "truncated": summary["values"] > len(groups),
+    }
+
+# 🛠 Tool schema for get_stats (MongoDB aggregation)
+get_the_stats = {
+    'type': 'function',
+    'function': {
+        'name': 'get_the_stats',
+        'description': 'Count leads, count leads per field value, or count leads per day/week/month/year. Use this instead of get_the_mango for "how many" questions.',
+        'parameters': {
+            'type': 'object',
+            'required': ['operation'],
+            'properties': {
+                'operation': {
+                    'type': 'string',
+                    'enum': ['count', 'group', 'date_bucket'],
+                    'description': 'count: number of matching leads. group: leads per value of group_by. date_bucket: leads per time interval of date_field.',
+                },
+                'match': {
+                    'type': 'object',
+                    'description': 'Optional MongoDB filter applied before aggregating, same fields as get_the_mango. Example: {"status": "New"}',
+                },
+                'group_by': {
+                    'type': 'string',
+                    'enum': LEAD_FIELDS,
+                    'description': 'Field to group by when operation is group, e.g. source or status.',
+                },
+                'date_field': {
+                    'type': 'string',
+                    'enum': ['createdAt', 'dateContacted'],
+                    'description': 'Date field to bucket when operation is date_bucket. Defaults to createdAt.',
+                },
+                'interval': {
+                    'type': 'string',
+                    'enum': list(DATE_BUCKET_FORMATS),
+                    'description': 'Bucket size when operation is date_bucket. Defaults to day. Only the latest periods are returned, use month or year for long ranges.',
+                },
             },
         },
     },
@@ -121,17 +806,103 @@ get_the_mango = {
 # 🧠 Map tool names to actual Python functions
 available_functions: Dict[str, Callable] = {
     'get_the_mango': get_data,
+    'get_the_stats': get_stats,
 }
 
-# 🚀 Main processing function
-def process_prompt(user_input, lead_data=None): # Added lead_data parameter
-    # Handle simple greetings
+async def call_tool(function_name, arguments):
+    function = available_functions[function_name]
+    if asyncio.iscoroutinefunction(function):
+        return await function(**arguments)
+    # Blocking tools run in a worker thread so the event loop stays free
+    return await asyncio.to_thread(function, **arguments)
+
+# 📏 Token budget for tool output sent back to the model
+TOOL_RESULT_MAX_ROWS = int(os.getenv("TOOL_RESULT_MAX_ROWS", "25"))
+TOOL_RESULT_TOKEN_BUDGET = int(os.getenv("TOOL_RESULT_TOKEN_BUDGET", "2000"))
+
+def estimate_tokens(data):
+    # Rough rule of thumb: ~4 characters per token
+    return len(json.dumps(data, default=str)) // 4
+
+def chunk_rows(rows):
+    # Split rows into chunks that each fit the row cap and the token budget
+    chunks, current, current_tokens = [], [], 0
+    for row in rows:
+        row_tokens = estimate_tokens(row)
+        if current and (len(current) >= TOOL_RESULT_MAX_ROWS or current_tokens + row_tokens > TOOL_RESULT_TOKEN_BUDGET):
+            chunks.append(current)
+            current, current_tokens = [], 0
+        current.append(row)
+        current_tokens += row_tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+async def summarize_chunk(user_input, chunk, index, total):
+    response = await chat_llm([
+        {"role": "system", "content": "You summarize CRM lead records. Be brief and keep every name, count and fact that helps answer the question."},
+        {"role": "user", "content": f"Question: {user_input}\nThis is part {index + 1} of {total} of the matching leads: {json.dumps(chunk, default=str)}\nSummarize these leads for answering the question."},
+    ])
+    return response['message']['content']
+
+async def budget_tool_output(user_input, function_output, all_rows=False):
+    if not isinstance(function_output, list):
+        return function_output
+    chunks = chunk_rows(function_output)
+    if len(chunks) <= 1:
+        return function_output
+    if not all_rows:
+        return {
+            "total_matches": len(function_output),
+            "leads": chunks[0],
+            "note": f"Only the first {len(chunks[0])} of {len(function_output)} matching leads are shown.",
+        }
+    # 🗺 Map: summarize every chunk concurrently, the reduce step is the normal summary call
+    print(f"🗺 Summarizing {len(function_output)} leads in {len(chunks)} chunks")
+    partial_summaries = await asyncio.gather(*(
+        summarize_chunk(user_input, chunk, index, len(chunks))
+        for index, chunk in enumerate(chunks)
+    ))
+    return {"total_matches": len(function_output), "partial_summaries": list(partial_summaries)}
+
+TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT", "30"))
+
+async def run_tool(user_input, function_name, arguments):
+    arguments = dict(arguments)
+    all_rows = bool(arguments.pop("all_rows", False))
+    # Only the lookup is timed, summarizing a large result queues on the model slots
+    function_output = await asyncio.wait_for(call_tool(function_name, arguments), TOOL_TIMEOUT)
+    return await budget_tool_output(user_input, function_output, all_rows)
+
+async def run_indexed_tool(user_input, index, tool):
+    # A failing or slow tool becomes an error result instead of failing the whole turn
+    function_name = tool['function']['name']
+    try:
+        function_output = await run_tool(user_input, function_name, tool['function']['arguments'])
+    except asyncio.TimeoutError:
+        function_output = {"error": f"{function_name} timed out after {TOOL_TIMEOUT:g} seconds"}
+    except KeyError:
+        function_output = {"error": f"Unknown tool {function_name}"}
+    except Exception as e:
+        function_output = {"error": f"{function_name} failed: {e}"}
+    return index, function_name, function_output
+
+async def run_tool_calls(user_input, tool_calls):
+    results = await asyncio.gather(*(
+        run_indexed_tool(user_input, index, tool) for index, tool in enumerate(tool_calls)
+    ))
+    return [(function_name, function_output) for _, function_name, function_output in results]
+
+def greeting_reply(user_input, lead_data=None):
+    # Handle simple greetings without a model call
     if user_input.lower() in ["hi", "hello", "hey", "greetings"]:
         if lead_data:
-            return {"message": f"Hello! How can I help you with {lead_data.get('name', 'this lead')} today?"}
+            return f"Hello! How can I help you with {lead_data.get('name', 'this lead')} today?"
         else:
-            return {"message": "Hello! How can I help you with your leads today?"}
+            return "Hello! How can I help you with your leads today?"
+    return None
 
+def build_messages(user_input, lead_data=None):
     messages = []
     tools_to_use = []
 
@@ -144,6 +915,7 @@ def process_prompt(user_input, lead_data=None): # Added lead_data parameter
         # General chat context
         messages.append({"role": "system", "content": """You are a helpful assistant that can retrieve lead information from a MongoDB database.
 When a user asks for information that requires a database query, you should use the 'get_the_mango' tool to formulate a MongoDB query.
+When a user asks how many leads there are, or for counts per source, status or time period, use the 'get_the_stats' tool instead.
 After the query is executed, you will receive the results. Your final response should be a human-readable summary of the retrieved information,
 not the MongoDB query itself.
 
@@ -159,10 +931,15 @@ Use the following fields for queries:
 🟢 Examples:
 
 User: "Show me details of Akshaj."
-(Tool call to get_the_mango with query: {{"name": {{"$regex": "Akshaj", "$options": "i"}}}} )
+(Tool call to get_the_mango with query: {{"name": {{"$regex": "^Akshaj$", "$options": "i"}}}} )
 (Tool output: [{{"name": "Akshaj", "email": "akshaj@example.com", "phone": "123-456-7890", "status": "New", "source": "Manual", "createdAt": "2025-07-10T10:00:00"}}])
 Assistant: "Akshaj's details are: Email: akshaj@example.com, Phone: 123-456-7890, Status: New, Source: Manual, Created At: 2025-07-10 10:00:00."
 
+User: "Find leads whose name starts with Raj."
+(Tool call to get_the_mango with query: {{"name": {{"$regex": "^Raj", "$options": "i"}}}} )
+(Tool output: [{{"name": "Raj Kumar", "email": "raj@example.com"}}])
+Assistant: "Raj Kumar (raj@example.com) is the only lead whose name starts with Raj."
+
 User: "Find leads created after July 1st, 2025."
 (Tool call to get_the_mango with query: {{"createdAt": {{"$gt": "2025-07-01T00:00:00"}}}} )
 (Tool output: [{{"name": "Lead A", "email": "a@example.com"}}, {{"name": "Lead B", "email": "b@example.com"}}])
@@ -178,107 +955,1339 @@ User: "Do we have any manual entries?"
 (Tool output: [{{"name": "Manual Lead 1", "source": "Manual"}}])
 Assistant: "Yes, we have manual entries, for example: Manual Lead 1."
 
+User: "How many new leads do we have?"
+(Tool call to get_the_stats with operation: "count", match: {{"status": "New"}} )
+(Tool output: {{"count": 12}})
+Assistant: "You have 12 new leads."
+
+User: "How many leads came from each source?"
+(Tool call to get_the_stats with operation: "group", group_by: "source" )
+(Tool output: {{"operation": "group", "total": 9, "groups": [{{"source": "Manual", "count": 6}}, {{"source": "Document", "count": 3}}]}})
+Assistant: "You have 9 leads: 6 from Manual and 3 from Document."
+
 If you cannot determine a meaningful query from the prompt, or if the query returns no results, inform the user.
 """})
-        tools_to_use = [get_the_mango]
+        tools_to_use = [get_the_mango, get_the_stats]
 
     messages.append({"role": "user", "content": user_input})
-    
-    response = ollama.chat(
-        model='crm',
-        messages=messages,
-        tools=tools_to_use, # Use the conditionally set tools
-        stream=False
-    )
+    return messages, tools_to_use
 
-    # 🔍 Check if a tool was called
-    if 'message' in response and 'tool_calls' in response['message']:
-        for tool in response['message']['tool_calls']:
-            function_name = tool['function']['name']
-            arguments = tool['function']['arguments']
-
-            # ✅ Execute corresponding Python function
-            function_output = available_functions[function_name](**arguments)
-
-            # 🎯 Send tool output back to LLM for summarization
-            messages.append({
-                "role": "tool",
-                "content": json.dumps(function_output, default=str),
-                # Removed "tool_call_id": tool['id'] as 'id' key might not exist
-            })
-            messages.append({
-                "role": "user",
-                "content": f"Based on the following data: {json.dumps(function_output, default=str)}, provide a human-readable summary of the lead information. If no data is provided, state that no leads were found."
-            })
-
-            final_response = ollama.chat(
-                model='crm',
-                messages=messages,
-                stream=False
+def tool_result_messages(tool_outputs):
+    # 🎯 Send tool output back to LLM for summarization, one tool message per call in call order
+    return [
+        {
+            "role": "tool",
+            "content": json.dumps(function_output, default=str),
+            # Removed "tool_call_id": tool['id'] as 'id' key might not exist
+        }
+        for _, function_output in tool_outputs
+    ] + [
+        {
+            # The data is already in the tool message, do not send it twice
+            "role": "user",
+            "content": "Based on the tool output above, provide a human-readable summary of the lead information. If no data is provided, state that no leads were found."
+        },
+    ]
+
+def format_lead_line(lead):
+    return f"- Name: {lead.get('name', 'N/A')}, Email: {lead.get('email', 'N/A')}, Phone: {lead.get('phone', 'N/A')}, Status: {lead.get('status', 'N/A')}, Source: {lead.get('source', 'N/A')}\n"
+
+# ⚡ Template rendering for small, structured tool results (skips the summary call)
+RENDER_MAX_ROWS = int(os.getenv("RENDER_MAX_ROWS", "10"))
+
+def render_tool_output(function_name, function_output):
+    # Returns None when the result should be phrased by the model instead
+    if function_name == 'get_the_mango' and isinstance(function_output, list):
+        if not function_output:
+            return "No leads were found."
+        if len(function_output) == 1:
+            lead = function_output[0]
+            details = ", ".join(f"{field}: {lead[field]}" for field in LEAD_FIELDS[1:] if lead.get(field) not in (None, ""))
+            return f"{lead.get('name', 'This lead')}'s details are: {details}." if details else f"Found one lead: {lead.get('name', 'N/A')}."
+        if len(function_output) <= RENDER_MAX_ROWS:
+            formatted_output = f"Found {len(function_output)} leads:\n"
+            for lead in function_output:
+                formatted_output += format_lead_line(lead)
+            return formatted_output
+        return None
+
+    if function_name == 'get_the_stats' and isinstance(function_output, dict) and "error" not in function_output:
+        if "count" in function_output:
+            count = function_output["count"]
+            return f"There {'is' if count == 1 else 'are'} {count} matching lead{'' if count == 1 else 's'}."
+        groups = function_output.get("groups", [])
+        if not groups:
+            return "No leads were found."
+        if len(groups) > RENDER_MAX_ROWS:
+            return None
+        formatted_output = f"Total: {function_output['total']} leads\n"
+        if function_output.get("truncated"):
+            kept = "Latest" if function_output.get("operation") == "date_bucket" else "Top"
+            formatted_output += f"{kept} {len(groups)} of {function_output['distinct_values']} values:\n"
+        for group in groups:
+            label = group.get("period") if function_output.get("operation") == "date_bucket" else next(
+                (value for key, value in group.items() if key != "count"), None
             )
-            
-            if 'message' in final_response and 'content' in final_response['message']:
-                # Attempt to parse JSON if the content looks like a JSON string
-                try:
-                    parsed_content = json.loads(final_response['message']['content'])
-                    # If it's a list of dicts (like lead data), format it nicely
-                    if isinstance(parsed_content, list) and all(isinstance(item, dict) for item in parsed_content):
-                        formatted_output = "Here are the lead details:\n"
-                        for lead in parsed_content:
-                            formatted_output += f"- Name: {lead.get('name', 'N/A')}, Email: {lead.get('email', 'N/A')}, Phone: {lead.get('phone', 'N/A')}, Status: {lead.get('status', 'N/A')}, Source: {lead.get('source', 'N/A')}\n"
-                        return {"message": formatted_output}
-                    else:
-                        return {"message": final_response['message']['content']}
-                except json.JSONDecodeError:
-                    # If not JSON, return as is
-                    return {"message": final_response['message']['content']}
-            else:
-                return {"message": "Could not process the tool output."}
+            formatted_output += f"- {label if label not in (None, '') else 'Unknown'}: {group['count']}\n"
+        return formatted_output
+
+    return None
+
+def render_tool_outputs(tool_outputs):
+    # Only skip the summary call when every tool result can be rendered
+    rendered = [render_tool_output(function_name, function_output) for function_name, function_output in tool_outputs]
+    if any(part is None for part in rendered):
+        return None
+    return "\n\n".join(part.strip() for part in rendered)
+
+def format_final_content(content):
+    # Attempt to parse JSON if the content looks like a JSON string
+    try:
+        parsed_content = json.loads(content)
+    except json.JSONDecodeError:
+        # If not JSON, return as is
+        return content
+    # If it's a list of dicts (like lead data), format it nicely
+    if isinstance(parsed_content, list) and all(isinstance(item, dict) for item in parsed_content):
+        formatted_output = "Here are the lead details:\n"
+        for lead in parsed_content:
+            formatted_output += format_lead_line(lead)
+        return formatted_output
+    return content
+
+# 🚀 Main processing function
+def tool_outputs_failed(tool_outputs):
+    # Timeouts, invalid queries and database errors come back as {"error": ...}
+    return any(isinstance(function_output, dict) and "error" in function_output for _, function_output in tool_outputs)
+
+async def process_prompt(user_input, lead_data=None, llm_summary=False): # Added lead_data parameter
+    # Returns the answer and whether it may be cached (not when a tool failed)
+    greeting = greeting_reply(user_input, lead_data)
+    if greeting:
+        return {"message": greeting}, True
+
+    messages, tools_to_use = build_messages(user_input, lead_data)
+
+    response = await chat_llm(messages, tools_to_use) # Use the conditionally set tools
+
+    # 🔍 Check if a tool was called
+    if 'message' in response and response['message'].get('tool_calls'):
+        # ✅ Execute every requested tool concurrently
+        tool_outputs = await run_tool_calls(user_input, response['message']['tool_calls'])
+        cacheable = not tool_outputs_failed(tool_outputs)
+
+        # ⚡ Small structured results are rendered directly unless LLM phrasing is requested
+        if not llm_summary:
+            rendered = render_tool_outputs(tool_outputs)
+            if rendered is not None:
+                return {"message": rendered}, cacheable
+
+        messages.extend(tool_result_messages(tool_outputs))
+
+        final_response = await chat_llm(messages)
+
+        if 'message' in final_response and 'content' in final_response['message']:
+            return {"message": format_final_content(final_response['message']['content'])}, cacheable
+        else:
+            return {"message": "Could not process the tool output."}, False
 
     # If no tool call triggered, return a default message or let the LLM respond directly
     if 'message' in response and 'content' in response['message']:
-        return {"message": response['message']['content']}
+        return {"message": response['message']['content']}, True
     else:
-        return {"message": "No tool call triggered and no direct response from AI."}
+        return {"message": "No tool call triggered and no direct response from AI."}, True
+
+# ⚡ Streaming variant of process_prompt, yields events as they are produced
+async def stream_prompt(user_input, lead_data=None, llm_summary=False):
+    greeting = greeting_reply(user_input, lead_data)
+    if greeting:
+        yield {"type": "token", "content": greeting}
+        yield {"type": "done"}
+        return
+
+    messages, tools_to_use = build_messages(user_input, lead_data)
+
+    tool_calls = []
+    async for chunk in stream_llm(messages, tools_to_use):
+        message = chunk['message']
+        if message.get('tool_calls'):
+            tool_calls.extend(message['tool_calls'])
+        if message.get('content'):
+            yield {"type": "token", "content": message['content']}
+
+    if tool_calls:
+        for tool in tool_calls:
+            yield {"type": "status", "tool": tool['function']['name'], "state": "running", "arguments": tool['function']['arguments']}
+
+        tool_outputs = [None] * len(tool_calls)
+        for finished in asyncio.as_completed([
+            run_indexed_tool(user_input, index, tool) for index, tool in enumerate(tool_calls)
+        ]):
+            index, function_name, function_output = await finished
+            tool_outputs[index] = (function_name, function_output)
+            if isinstance(function_output, dict) and "error" in function_output:
+                yield {"type": "status", "tool": function_name, "state": "failed", "error": function_output["error"]}
+            else:
+                yield {"type": "status", "tool": function_name, "state": "finished"}
+
+        rendered = None if llm_summary else render_tool_outputs(tool_outputs)
+        if rendered is not None:
+            yield {"type": "token", "content": rendered}
+        else:
+            messages.extend(tool_result_messages(tool_outputs))
+            async for chunk in stream_llm(messages):
+                if chunk['message'].get('content'):
+                    yield {"type": "token", "content": chunk['message']['content']}
+
+    yield {"type": "done"}
+
+# 💾 Answer cache in front of process_prompt, cleared whenever leads change
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "256"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "300"))
+
+answer_cache = TTLCache(maxsize=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL)
+answer_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0, "seconds_saved": 0.0}
+# Bumped on every leads_collection write so in-flight answers are not cached stale
+leads_version = 0
+
+def notify_leads_changed(reason):
+    global leads_version
+    leads_version += 1
+    if answer_cache:
+        answer_cache.clear()
+        answer_cache_stats["invalidations"] += 1
+    print(f"♻ Leads changed ({reason}), caches invalidated")
+
+async def watch_leads():
+    # Also catches writes made outside this API (e.g. the Node.js server)
+    try:
+        async with leads_collection.watch() as stream:
+            async for change in stream:
+                notify_leads_changed(f"change stream: {change['operationType']}")
+    except PyMongoError as e:
+        print(f"⚠ Leads change stream unavailable, relying on API write hooks: {e}")
+
+def answer_cache_key(user_input, lead_data=None, llm_summary=False):
+    normalized = re.sub(r"\s+", " ", user_input.strip().lower()).rstrip("?!. ")
+    lead_key = None
+    if lead_data:
+        # The answer is built from the lead as sent, so an edited lead must not hit the old entry
+        lead_key = hashlib.sha256(json.dumps(lead_data, sort_keys=True, default=str).encode()).hexdigest()
+    return normalized, lead_key, llm_summary
+
+async def answer_prompt(user_input, lead_data=None, llm_summary=False):
+    key = answer_cache_key(user_input, lead_data, llm_summary)
+    cached = answer_cache.get(key)
+    if cached is not None:
+        result, elapsed = cached
+        answer_cache_stats["hits"] += 1
+        answer_cache_stats["seconds_saved"] += elapsed
+        return result
+
+    answer_cache_stats["misses"] += 1
+    version = leads_version
+    started = time.perf_counter()
+    result, cacheable = await process_prompt(user_input, lead_data, llm_summary)
+    # A failed tool call is not replayed from the cache
+    if cacheable and version == leads_version:
+        answer_cache[key] = (result, time.perf_counter() - started)
+    return result
+
+async def answer_prompt_stream(user_input, lead_data=None, llm_summary=False):
+    key = answer_cache_key(user_input, lead_data, llm_summary)
+    cached = answer_cache.get(key)
+    if cached is not None:
+        result, elapsed = cached
+        answer_cache_stats["hits"] += 1
+        answer_cache_stats["seconds_saved"] += elapsed
+        yield {"type": "token", "content": result["message"], "cached": True}
+        yield {"type": "done"}
+        return
+
+    answer_cache_stats["misses"] += 1
+    version = leads_version
+    started = time.perf_counter()
+    tokens, cacheable = [], True
+    async for event in stream_prompt(user_input, lead_data, llm_summary):
+        if event["type"] == "token":
+            tokens.append(event["content"])
+        elif event["type"] == "status" and event["state"] == "failed":
+            cacheable = False
+        yield event
+    if cacheable and version == leads_version:
+        answer_cache[key] = ({"message": "".join(tokens)}, time.perf_counter() - started)
+
+def answer_cache_snapshot():
+    lookups = answer_cache_stats["hits"] + answer_cache_stats["misses"]
+    return {
+        **answer_cache_stats,
+        "size": len(answer_cache),
+        "hit_rate": answer_cache_stats["hits"] / lookups if lookups else 0.0,
+    }
+
+# 📦 Uploads stay in the spooled temp files the multipart parser writes them to
+def upload_size(stream):
+    stream.seek(0, os.SEEK_END)
+    return stream.tell()
+
+def upload_digest(stream):
+    # Hash in chunks so the upload is never copied into memory as a whole
+    stream.seek(0)
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b""):
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+def check_upload_size(file):
+    if (file.size or 0) > UPLOAD_MAX_BYTES:
+        raise UploadTooLarge(f"{file.filename} is larger than {UPLOAD_MAX_BYTES} bytes")
+
+EXTRACT_PROMPT = (
+    "Extract the name, email, and phone number (including country code) "
+    "from this image. Provide the output as a JSON object with keys "
+    "'name', 'email', and 'phone' (with country code). For example: "
+    '{"name": "John Doe", "email": "john.doe@example.com", "phone": "+1234567890"}'
+)
+EXTRACT_MULTI_PROMPT = (
+    "Extract every person listed in this document. For each one give the name, "
+    "email, and phone number (including country code). Use an empty string for "
+    "anything that is missing. Provide the output as a JSON object with a 'leads' "
+    "list, for example: "
+    '{"leads": [{"name": "John Doe", "email": "john.doe@example.com", "phone": "+1234567890"}]}'
+)
+EXTRACT_MULTI_MAX_PAGES = int(os.getenv("EXTRACT_MULTI_MAX_PAGES", "50"))
+# Gemini calls allowed at once and per minute for document extraction
+EXTRACT_CONCURRENCY = int(os.getenv("EXTRACT_CONCURRENCY", "4"))
+EXTRACT_RATE_PER_MINUTE = float(os.getenv("EXTRACT_RATE_PER_MINUTE", "60"))
+EXTRACT_BATCH_MAX_FILES = int(os.getenv("EXTRACT_BATCH_MAX_FILES", "100"))
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "60"))
+DISCONNECT_POLL_INTERVAL = 0.5
+
+class RateLimiter:
+    # Spaces calls evenly so bursts stay under the per-minute quota
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0.0
+        self.next_slot = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            now = time.monotonic()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+extract_semaphore = asyncio.Semaphore(EXTRACT_CONCURRENCY)
+extract_rate_limiter = RateLimiter(EXTRACT_RATE_PER_MINUTE)
+
+# 🖼 Image preprocessing before upload: crop, downscale, recompress, drop metadata
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1600"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+image_stats = {"images": 0, "bytes_in": 0, "bytes_out": 0, "preprocess_ms": 0.0, "gemini_calls": 0, "gemini_ms": 0.0}
+
+def crop_to_content(image):
+    # Trim the border that has the same colour as the top-left pixel
+    background = Image.new(image.mode, image.size, image.getpixel((0, 0)))
+    bbox = ImageChops.difference(image, background).getbbox()
+    return image.crop(bbox) if bbox else image
+
+def flatten_image(image):
+    # Transparent areas become white, not black, so dark text on them stays readable
+    if image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    return image.convert("RGB")
+
+def preprocess_image(stream, content_type):
+    # Returns (bytes, content_type) read from the spooled upload, unchanged when the result would not be smaller
+    original_size = upload_size(stream)
+    if Image is not None and content_type and content_type.startswith("image/"):
+        try:
+            stream.seek(0)
+            with Image.open(stream) as original:
+                image = flatten_image(ImageOps.exif_transpose(original))
+            image = crop_to_content(image)
+            image.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE))
+            buffer = io.BytesIO()
+            # A fresh JPEG without exif carries no metadata from the original
+            image.save(buffer, format="JPEG", quality=IMAGE_QUALITY, optimize=True)
+            if buffer.tell() < original_size:
+                return buffer.getvalue(), "image/jpeg"
+        except Exception as e:
+            print(f"⚠ Image preprocessing skipped: {e}")
+    stream.seek(0)
+    return stream.read(), content_type
+
+async def extract_lead(stream, content_type):
+    # stream is the spooled upload, it is only read into memory for the model call
+    started = time.perf_counter()
+    image_bytes, upload_content_type = await asyncio.to_thread(preprocess_image, stream, content_type)
+    if content_type and content_type.startswith("image/"):
+        image_stats["images"] += 1
+        image_stats["bytes_in"] += upload_size(stream)
+        image_stats["bytes_out"] += len(image_bytes)
+        image_stats["preprocess_ms"] += (time.perf_counter() - started) * 1000
+    content_type = upload_content_type
+
+    extracted = await extract_structured(image_bytes, content_type, EXTRACT_PROMPT, ExtractedLead)
+    # Add source before saving to database
+    return {**extracted.model_dump(), "source": "Document"}
+
+async def extract_structured(image_bytes, content_type, prompt, schema):
+    # Only malformed responses are retried, after a local repair attempt
+    for attempt in range(EXTRACT_PARSE_RETRIES + 1):
+        response_text = await generate_extraction(image_bytes, content_type, prompt, schema)
+        try:
+            return parse_extraction(response_text, schema)
+        except ValidationError as e:
+            print(f"⚠ Malformed extraction (attempt {attempt + 1}): {response_text!r}")
+            if attempt == EXTRACT_PARSE_RETRIES:
+                extraction_parse_stats["failed"] += 1
+                raise ValueError(f"Could not parse extraction result: {e.errors()[0]['msg']}") from None
+            extraction_parse_stats["retried"] += 1
+
+async def generate_extraction(image_bytes, content_type, prompt=EXTRACT_PROMPT, schema=ExtractedLead):
+    async with extract_semaphore:
+        await extract_rate_limiter.acquire()
+        started = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(
+                model.generate_content_async(
+                    [
+                        {
+                            "mime_type": content_type,
+                            "data": image_bytes
+                        },
+                        prompt
+                    ],
+                    # Ask for bare JSON constrained to the response schema
+                    generation_config={"response_mime_type": "application/json", "response_schema": schema},
+                    request_options={"timeout": GEMINI_TIMEOUT},
+                ),
+                GEMINI_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Gemini extraction timed out after {GEMINI_TIMEOUT:g} seconds") from None
+        finally:
+            image_stats["gemini_calls"] += 1
+            image_stats["gemini_ms"] += (time.perf_counter() - started) * 1000
+    return response.text
+
+# 🧾 Parsing of extraction output
+EXTRACT_PARSE_RETRIES = int(os.getenv("EXTRACT_PARSE_RETRIES", "1"))
+extraction_parse_stats = {"ok": 0, "repaired": 0, "retried": 0, "failed": 0}
+
+def repair_json(text):
+    # Cheap fixes for the usual drift: code fences, prose around the object, smart quotes, trailing commas
+    text = re.sub(r"^```(?:json)?\s*|\s*```$", "", text.strip(), flags=re.IGNORECASE)
+    start, end = text.find("{"), text.rfind("}")
+    if start != -1 and end > start:
+        text = text[start:end + 1]
+    text = text.replace("\u201c", '"').replace("\u201d", '"')
+    return re.sub(r",\s*([}\]])", r"\1", text)
+
+def parse_extraction(text, schema=ExtractedLead):
+    try:
+        extracted = schema.model_validate_json(text)
+        extraction_parse_stats["ok"] += 1
+        return extracted
+    except ValidationError:
+        pass
+    extracted = schema.model_validate_json(repair_json(text))
+    extraction_parse_stats["repaired"] += 1
+    return extracted
+
+# 🔤 Local pre-extraction from text layers, Gemini is only the fallback
+LOCAL_EXTRACT_MIN_CONFIDENCE = float(os.getenv("LOCAL_EXTRACT_MIN_CONFIDENCE", "0.85"))
+# Used for numbers written without a country code, e.g. "+91"
+DEFAULT_COUNTRY_CODE = os.getenv("DEFAULT_COUNTRY_CODE", "")
+LOCAL_EXTRACT_MAX_PAGES = 5
+EMAIL_PATTERN = re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
+PHONE_PATTERN = re.compile(r"\+?\d[\d\s().-]{6,}\d")
+NAME_LABEL_PATTERN = re.compile(r"^\s*(?:full\s+)?name\s*[:\-]\s*(.+)$", re.IGNORECASE | re.MULTILINE)
+NAME_LINE_PATTERN = re.compile(r"^[A-Z][a-zA-Z'.-]+(?: [A-Z][a-zA-Z'.-]+){1,3}$")
+local_extract_stats = {"local": 0, "fallback": 0, "no_text": 0}
+
+def document_text(stream, content_type):
+    # Returns the text layer of PDFs and plain text uploads, None for everything else
+    stream.seek(0)
+    if content_type == "application/pdf":
+        if PdfReader is None:
+            return None
+        try:
+            reader = PdfReader(stream)
+            return "\n".join(page.extract_text() or "" for page in reader.pages[:LOCAL_EXTRACT_MAX_PAGES])
+        except Exception as e:
+            print(f"⚠ Could not read PDF text layer: {e}")
+            return None
+    if content_type and content_type.startswith("text/"):
+        return stream.read().decode("utf-8", errors="ignore")
+    return None
+
+def normalize_phone(raw):
+    # E.164: + followed by 8 to 15 digits
+    digits = re.sub(r"\D", "", raw)
+    if raw.strip().startswith("+"):
+        candidate = "+" + digits
+    elif digits.startswith("00"):
+        candidate = "+" + digits[2:]
+    elif DEFAULT_COUNTRY_CODE:
+        candidate = DEFAULT_COUNTRY_CODE + digits.lstrip("0")
+    else:
+        return None
+    return candidate if 8 <= len(candidate) - 1 <= 15 else None
+
+def local_extract(text):
+    # Returns (lead, confidence) from simple patterns
+    lead, confidence = {}, 0.0
+
+    emails = list(dict.fromkeys(email.lower() for email in EMAIL_PATTERN.findall(text)))
+    if emails:
+        lead["email"] = emails[0]
+        # Several addresses usually means several people or a company inbox
+        confidence += 0.4 if len(emails) == 1 else 0.15
+
+    phones = list(dict.fromkeys(filter(None, (normalize_phone(match) for match in PHONE_PATTERN.findall(text)))))
+    if phones:
+        lead["phone"] = phones[0]
+        confidence += 0.3 if len(phones) == 1 else 0.15
+
+    label = NAME_LABEL_PATTERN.search(text)
+    name_lines = [line.strip() for line in text.splitlines() if NAME_LINE_PATTERN.match(line.strip())]
+    if label:
+        lead["name"] = label.group(1).strip()
+        confidence += 0.3
+    elif name_lines:
+        lead["name"] = name_lines[0]
+        # With several name-like lines (company, title, person) the pick is a guess,
+        # keep the score below the threshold so Gemini decides
+        confidence += 0.3 if len(name_lines) == 1 else 0.1
+    elif emails:
+        # john.doe@example.com -> John Doe
+        lead["name"] = " ".join(part.capitalize() for part in re.split(r"[._-]+", emails[0].split("@")[0]) if part)
+        confidence += 0.1
+
+    return lead, round(confidence, 2)
+
+class ClientDisconnected(Exception):
+    pass
+
+async def cancel_on_disconnect(request, coro):
+    # Stop paying for model calls nobody is waiting for
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
+
+# 🔁 Upserting leads by email so re-uploads update instead of duplicating
+class MissingEmail(ValueError):
+    # Leads are keyed on the unique, non-sparse email_1 index, so a lead without an email cannot be stored
+    pass
+
+def lead_upsert_spec(document):
+    # Returns (email, update) for an upsert keyed on email
+    # Blank values never overwrite what an existing lead already has
+    document = {key: value for key, value in document.items() if value not in ("", None)}
+    email = (document.get("email") or "").strip().lower()
+    if not email:
+        raise MissingEmail("No email found, the lead was not saved")
+    document["email"] = email
+    defaults = {"status": "New", "createdAt": datetime.datetime.now(datetime.timezone.utc)}
+    # An existing lead keeps its original source
+    on_insert = {**defaults, "source": document.pop("source", "Document")}
+    on_insert = {key: value for key, value in on_insert.items() if key not in document}
+    return email, {"$set": document, "$setOnInsert": on_insert}
+
+async def upsert_lead(document):
+    # Returns the lead id and whether a new lead was created, raises MissingEmail
+    email, payload = lead_upsert_spec(document)
+    before = await leads_collection.find_one_and_update(
+        {"email": email}, payload, upsert=True,
+        projection={"_id": 1}, return_document=ReturnDocument.BEFORE,
+    )
+    if before is not None:
+        return str(before["_id"]), False
+    created = await leads_collection.find_one({"email": email}, {"_id": 1})
+    return str(created["_id"]), True
+
+async def write_lead_upserts(specs):
+    # One unordered bulk_write of lead_upsert_spec upserts, returns the raw bulk result
+    operations = [UpdateOne({"email": email}, payload, upsert=True) for email, payload in specs]
+    try:
+        result = await leads_collection.bulk_write(operations, ordered=False)
+        return result.bulk_api_result
+    except BulkWriteError as e:
+        return e.details
+
+async def bulk_upsert_leads(documents):
+    # Returns {"id", "created"}, {"error"} or {"skipped": "no email"} per document
+    specs = []
+    for document in documents:
+        try:
+            specs.append(lead_upsert_spec(document))
+        except MissingEmail:
+            specs.append(None)
+    writable = [index for index, spec in enumerate(specs) if spec is not None]
+    details = await write_lead_upserts([specs[index] for index in writable]) if writable else {}
+    # Bulk result indexes refer to the writable leads only
+    write_errors = {writable[error["index"]]: error["errmsg"] for error in details.get("writeErrors", [])}
+    upserted_ids = {writable[item["index"]]: item["_id"] for item in details.get("upserted", [])}
+
+    # Updated leads keep their existing _id, look them all up at once
+    matched_emails = [
+        specs[index][0] for index in writable
+        if index not in write_errors and index not in upserted_ids
+    ]
+    existing_ids = {}
+    if matched_emails:
+        async for lead in leads_collection.find({"email": {"$in": matched_emails}}, {"_id": 1, "email": 1}):
+            existing_ids[lead["email"]] = lead["_id"]
+
+    outcomes = []
+    for index, spec in enumerate(specs):
+        if spec is None:
+            outcomes.append({"skipped": "no email"})
+        elif index in write_errors:
+            outcomes.append({"error": write_errors[index]})
+        elif index in upserted_ids:
+            outcomes.append({"id": str(upserted_ids[index]), "created": True})
+        else:
+            outcomes.append({"id": str(existing_ids.get(spec[0])), "created": False})
+    return outcomes
+
+# #️⃣ Extraction results cached by content hash, in memory with MongoDB behind it
+EXTRACTION_CACHE_SIZE = int(os.getenv("EXTRACTION_CACHE_SIZE", "1024"))
+extraction_cache = LRUCache(maxsize=EXTRACTION_CACHE_SIZE)
+extraction_cache_stats = {"memory_hits": 0, "mongo_hits": 0, "misses": 0}
+
+async def get_cached_extraction(key):
+    cached = extraction_cache.get(key)
+    if cached is not None:
+        extraction_cache_stats["memory_hits"] += 1
+        return cached
+    stored = await extraction_cache_collection.find_one({"_id": key})
+    if stored is not None:
+        extraction_cache_stats["mongo_hits"] += 1
+        extraction_cache[key] = stored["data"]
+        return stored["data"]
+    extraction_cache_stats["misses"] += 1
+    return None
+
+async def store_cached_extraction(key, data, content_type):
+    extraction_cache[key] = data
+    await extraction_cache_collection.replace_one(
+        {"_id": key},
+        {"_id": key, "data": data, "contentType": content_type, "createdAt": datetime.datetime.now(datetime.timezone.utc)},
+        upsert=True,
+    )
+
+async def cached_extract_lead(stream, content_type, digest=None):
+    # Returns the extracted lead and whether it came from the cache
+    if digest is None:
+        digest = await asyncio.to_thread(upload_digest, stream)
+    cached = await get_cached_extraction(digest)
+    if cached is not None:
+        return dict(cached), True
+
+    extracted_data = None
+    text = await asyncio.to_thread(document_text, stream, content_type)
+    if text:
+        lead, confidence = local_extract(text)
+        if confidence >= LOCAL_EXTRACT_MIN_CONFIDENCE and {"name", "email", "phone"} <= set(lead):
+            local_extract_stats["local"] += 1
+            print(f"🔤 Extracted locally with confidence {confidence}")
+            extracted_data = {**lead, "source": "Document"}
+        else:
+            local_extract_stats["fallback"] += 1
+    else:
+        local_extract_stats["no_text"] += 1
+    if extracted_data is None:
+        extracted_data = await extract_lead(stream, content_type)
+    await store_cached_extraction(digest, extracted_data, content_type)
+    return dict(extracted_data), False
+
+# 👥 Multi-lead extraction: attendee lists, sign-up sheets, spreadsheet screenshots
+def split_document(stream, content_type):
+    # Returns (parts, total_pages): (bytes, content_type) parts, one per PDF page when pages can be split,
+    # and the page count of the document, which is larger than len(parts) when pages were cut off
+    if content_type == "application/pdf" and PdfReader is not None:
+        stream.seek(0)
+        reader = PdfReader(stream)
+        if len(reader.pages) > 1:
+            pages = []
+            for page in reader.pages[:EXTRACT_MULTI_MAX_PAGES]:
+                writer = PdfWriter()
+                writer.add_page(page)
+                buffer = io.BytesIO()
+                writer.write(buffer)
+                pages.append((buffer.getvalue(), content_type))
+            return pages, len(reader.pages)
+    return [preprocess_image(stream, content_type)], 1
+
+async def cached_extract_leads(stream, content_type):
+    # Returns every lead in the document, the number of parts sent to Gemini,
+    # the page count of the document and whether it was cached
+    key = f"multi:{await asyncio.to_thread(upload_digest, stream)}"
+    cached = await get_cached_extraction(key)
+    if cached is not None:
+        return [dict(lead) for lead in cached["leads"]], cached["pages"], cached.get("totalPages", cached["pages"]), True
+
+    parts, total_pages = await asyncio.to_thread(split_document, stream, content_type)
+    # Pages run in parallel, bounded by the extraction semaphore and rate limiter
+    extracted = await asyncio.gather(*(
+        extract_structured(data, part_type, EXTRACT_MULTI_PROMPT, ExtractedLeadList) for data, part_type in parts
+    ))
+    leads, seen = [], set()
+    for page in extracted:
+        for lead in page.leads:
+            key_email = lead.email.strip().lower()
+            if not (lead.name.strip() or key_email) or (key_email and key_email in seen):
+                continue
+            if key_email:
+                seen.add(key_email)
+            leads.append({**lead.model_dump(), "source": "Document"})
+    await store_cached_extraction(key, {"leads": leads, "pages": len(parts), "totalPages": total_pages}, content_type)
+    return [dict(lead) for lead in leads], len(parts), total_pages, False
+
+# 🔑 Idempotency-Key support: retries get the original response without re-running model calls or inserts
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", str(24 * 3600)))
+# A pending key whose request never finished (e.g. the process was killed) can be retried after this
+IDEMPOTENCY_PENDING_TIMEOUT = int(os.getenv("IDEMPOTENCY_PENDING_TIMEOUT", "300"))
+idempotency_cache = TTLCache(maxsize=4096, ttl=IDEMPOTENCY_TTL)
+# Requests with a key that are still running in this process
+idempotency_inflight = {}
+
+async def ensure_idempotency_index():
+    try:
+        await idempotency_collection.create_index("createdAt", name="createdAt_ttl", expireAfterSeconds=IDEMPOTENCY_TTL)
+    except PyMongoError as e:
+        print(f"⚠ Could not create idempotency TTL index: {e}")
+
+async def claim_idempotency_key(record_id, fingerprint):
+    # Returns (claim_id, None) when this request should run, or (None, existing record) otherwise
+    claim_id = uuid.uuid4().hex
+    now = utcnow()
+    pending = {
+        "status": "pending",
+        "fingerprint": fingerprint,
+        "claimId": claim_id,
+        "pendingUntil": now + datetime.timedelta(seconds=IDEMPOTENCY_PENDING_TIMEOUT),
+        "createdAt": now,
+    }
+    try:
+        await idempotency_collection.insert_one({"_id": record_id, **pending})
+        return claim_id, None
+    except DuplicateKeyError:
+        pass
+    # Take over a pending record whose request died before finishing
+    taken = await idempotency_collection.find_one_and_update(
+        {"_id": record_id, "status": "pending", "pendingUntil": {"$not": {"$gte": now}}},
+        {"$set": pending},
+    )
+    if taken is not None:
+        return claim_id, None
+    return None, await idempotency_collection.find_one({"_id": record_id})
+
+def replay_response(stored):
+    return JSONResponse(content=stored["content"], status_code=stored["status_code"], headers={"Idempotent-Replayed": "true"})
+
+async def idempotent(request, endpoint, handler, fingerprint):
+    key = request.headers.get("Idempotency-Key")
+    if not key:
+        return await handler()
+    record_id = f"{endpoint}:{key}"
+
+    stored = idempotency_cache.get(record_id)
+    if stored is None and record_id in idempotency_inflight:
+        # The first request is still running here, share its outcome
+        stored = await asyncio.shield(idempotency_inflight[record_id])
+    if stored is not None:
+        if stored["fingerprint"] != fingerprint:
+            return JSONResponse(content={"error": "Idempotency-Key was already used with a different request"}, status_code=422)
+        return replay_response(stored)
+
+    claim_id, existing = await claim_idempotency_key(record_id, fingerprint)
+    if claim_id is None:
+        if existing is None or existing["status"] == "pending":
+            return JSONResponse(content={"error": "A request with this Idempotency-Key is still in progress"}, status_code=409)
+        stored = {"content": existing["content"], "status_code": existing["statusCode"], "fingerprint": existing["fingerprint"]}
+        idempotency_cache[record_id] = stored
+        if stored["fingerprint"] != fingerprint:
+            return JSONResponse(content={"error": "Idempotency-Key was already used with a different request"}, status_code=422)
+        return replay_response(stored)
+
+    inflight = asyncio.get_running_loop().create_future()
+    idempotency_inflight[record_id] = inflight
+    try:
+        response = await handler()
+        stored = {"content": json.loads(response.body), "status_code": response.status_code, "fingerprint": fingerprint}
+        if response.status_code < 400:
+            await idempotency_collection.update_one(
+                {"_id": record_id, "claimId": claim_id},
+                {"$set": {"status": "done", "content": stored["content"], "statusCode": stored["status_code"]},
+                 "$unset": {"pendingUntil": ""}},
+            )
+            idempotency_cache[record_id] = stored
+        else:
+            # Failures and disconnects are not remembered so the client can retry them
+            await idempotency_collection.delete_one({"_id": record_id, "claimId": claim_id})
+        inflight.set_result(stored)
+        return response
+    except BaseException as e:
+        await idempotency_collection.delete_one({"_id": record_id, "claimId": claim_id})
+        inflight.set_exception(e)
+        # Only waiters see the exception, do not log it as unretrieved
+        inflight.exception()
+        raise
+    finally:
+        idempotency_inflight.pop(record_id, None)
 
 @app.post("/extract")
-async def extract_data(file: UploadFile = File(...)):
-    image_bytes = await file.read()
-    prompt_message = (
-        "Extract the name, email, and phone number (including country code) "
-        "from this image. Provide the output as a JSON object with keys "
-        "'name', 'email', and 'phone' (with country code). For example: "
-        '{"name": "John Doe", "email": "john.doe@example.com", "phone": "+1234567890"}'
+async def extract_data(request: Request, file: UploadFile = File(...)):
+    check_upload_size(file)
+    digest = None
+    if request.headers.get("Idempotency-Key"):
+        # The upload hash is both the request fingerprint and the extraction cache key
+        digest = await asyncio.to_thread(upload_digest, file.file)
+    return await idempotent(request, "/extract", lambda: extract_single(request, file, digest), digest)
+
+async def extract_single(request, file, digest=None):
+    try:
+        extracted_data, cached = await cancel_on_disconnect(request, cached_extract_lead(file.file, file.content_type, digest))
+        lead_id, created = await upsert_lead(extracted_data)
+        notify_leads_changed("/extract")
+
+        return JSONResponse(content={
+            "message": "Lead extracted and saved successfully" if created else "Lead extracted and existing lead updated",
+            "id": lead_id,
+            "cached": cached,
+        })
+    except MissingEmail as e:
+        return JSONResponse(content={"error": str(e)}, status_code=422)
+    except ClientDisconnected:
+        print(f"🔌 Client disconnected, extraction of {file.filename} cancelled")
+        return JSONResponse(content={"error": "Client disconnected"}, status_code=499)
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+@app.post("/extract/multi")
+async def extract_data_multi(request: Request, file: UploadFile = File(...)):
+    check_upload_size(file)
+    try:
+        leads, pages, total_pages, cached = await cancel_on_disconnect(
+            request, cached_extract_leads(file.file, file.content_type)
+        )
+        # Every lead in the document is upserted in one round trip
+        outcomes = await bulk_upsert_leads(leads) if leads else []
+        results = [{"lead": lead, **outcome} for lead, outcome in zip(leads, outcomes)]
+        saved = sum("id" in result for result in results)
+        if saved:
+            notify_leads_changed("/extract/multi")
+        message = f"Saved {saved} of {len(leads)} leads found in {pages} page(s)"
+        if total_pages > pages:
+            message += f", only the first {pages} of {total_pages} pages were read"
+        return JSONResponse(content={
+            "message": message,
+            "saved": saved,
+            "skipped": sum("skipped" in result for result in results),
+            "pages": pages,
+            "total_pages": total_pages,
+            "truncated": total_pages > pages,
+            "cached": cached,
+            "results": results,
+        })
+    except ClientDisconnected:
+        print(f"🔌 Client disconnected, extraction of {file.filename} cancelled")
+        return JSONResponse(content={"error": "Client disconnected"}, status_code=499)
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+@app.post("/extract/batch")
+async def extract_data_batch(request: Request, files: list[UploadFile] = File(...)):
+    if len(files) > EXTRACT_BATCH_MAX_FILES:
+        return JSONResponse(content={"error": f"At most {EXTRACT_BATCH_MAX_FILES} files per batch"}, status_code=413)
+
+    async def extract_file(file):
+        try:
+            # An oversized file only fails its own entry
+            check_upload_size(file)
+            return await cached_extract_lead(file.file, file.content_type)
+        except UploadTooLarge as e:
+            return ValueError(e.detail)
+        except Exception as e:
+            return e
+
+    try:
+        extracted = await cancel_on_disconnect(request, asyncio.gather(*(extract_file(file) for file in files)))
+    except ClientDisconnected:
+        print(f"🔌 Client disconnected, batch of {len(files)} files cancelled")
+        return JSONResponse(content={"error": "Client disconnected"}, status_code=499)
+    statuses = [
+        {"filename": file.filename, "status": "error", "error": str(data)} if isinstance(data, Exception)
+        else {"filename": file.filename, "status": "extracted", "lead": data[0], "cached": data[1]}
+        for file, data in zip(files, extracted)
+    ]
+
+    # One bulk upsert for every successful extraction
+    pending = [status for status in statuses if status["status"] == "extracted"]
+    if pending:
+        documents = [status.pop("lead") for status in pending]
+        outcomes = await bulk_upsert_leads(documents)
+        for status, outcome in zip(pending, outcomes):
+            if "error" in outcome:
+                status.update(status="error", error=outcome["error"])
+            elif "skipped" in outcome:
+                status.update(status="skipped", reason=outcome["skipped"])
+            else:
+                status.update(status="saved", id=outcome["id"], created=outcome["created"])
+        if any("id" in outcome for outcome in outcomes):
+            notify_leads_changed("/extract/batch")
+
+    saved = sum(status["status"] == "saved" for status in statuses)
+    return JSONResponse(content={
+        "message": f"Saved {saved} of {len(files)} leads",
+        "saved": saved,
+        "failed": len(files) - saved,
+        "results": statuses,
+    })
+
+# 📥 Bulk lead import from CSV or JSONL, streamed from the spooled upload in fixed-size chunks
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "1000"))
+IMPORT_MAX_ERRORS = int(os.getenv("IMPORT_MAX_ERRORS", "1000"))
+
+def import_rows(stream, file_format):
+    # Yields (row_number, raw_row) lazily so memory does not grow with the file
+    stream.seek(0)
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", errors="replace", newline="")
+    if file_format == "csv":
+        for row_number, row in enumerate(csv.DictReader(text), start=2):
+            yield row_number, row
+    else:
+        for row_number, line in enumerate(text, start=1):
+            if line.strip():
+                try:
+                    yield row_number, json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield row_number, e
+
+def validate_import_chunk(rows):
+    valid, errors = [], []
+    for row_number, row in rows:
+        if isinstance(row, Exception):
+            errors.append({"row": row_number, "error": f"Invalid JSON: {row}"})
+            continue
+        if not isinstance(row, dict):
+            errors.append({"row": row_number, "error": "Row must be an object"})
+            continue
+        # Header names are matched case-insensitively, scalar values are read as text
+        fields = {
+            str(key).strip().lower(): value if isinstance(value, str) else str(value)
+            for key, value in row.items() if key and value not in (None, "")
+        }
+        fields["source"] = fields.get("source") or "Import"
+        try:
+            lead = LeadData(**fields)
+        except ValidationError as e:
+            errors.append({"row": row_number, "error": "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())})
+            continue
+        # Leads are keyed on email, see MissingEmail
+        if not lead.email.strip():
+            errors.append({"row": row_number, "error": "email: no email"})
+            continue
+        valid.append((row_number, lead.model_dump()))
+    return valid, errors
+
+async def write_import_chunk(valid):
+    # Returns (inserted, updated, errors)
+    details = await write_lead_upserts([lead_upsert_spec(document) for _, document in valid])
+    errors = [{"row": valid[error["index"]][0], "error": error["errmsg"]} for error in details.get("writeErrors", [])]
+    inserted = details.get("nInserted", 0) + details.get("nUpserted", 0)
+    return inserted, details.get("nMatched", 0), errors
+
+@app.post("/leads/import")
+async def import_leads(file: UploadFile = File(...), format: Optional[str] = None):
+    file_format = (format or os.path.splitext(file.filename or "")[1].lstrip(".") or "").lower()
+    if file_format == "ndjson":
+        file_format = "jsonl"
+    if file_format not in ("csv", "jsonl"):
+        return JSONResponse(content={"error": "Upload a .csv or .jsonl file, or pass format=csv|jsonl"}, status_code=400)
+
+    # The form closes its files when the endpoint returns, but the import streams on after that
+    stream, file.file = file.file, io.BytesIO()
+
+    async def event_source():
+        progress = {"rows": 0, "inserted": 0, "updated": 0, "failed": 0}
+        errors = []
+        rows = import_rows(stream, file_format)
+
+        def next_chunk():
+            chunk = []
+            for item in rows:
+                chunk.append(item)
+                if len(chunk) >= IMPORT_CHUNK_SIZE:
+                    break
+            return validate_import_chunk(chunk) if chunk else None
+
+        def record_errors(chunk_errors):
+            progress["failed"] += len(chunk_errors)
+            errors.extend(chunk_errors[:max(IMPORT_MAX_ERRORS - len(errors), 0)])
+
+        try:
+            pending_write = None
+            while True:
+                # Parse the next chunk while the previous one is being written
+                chunk = await asyncio.to_thread(next_chunk)
+                if pending_write is not None:
+                    inserted, updated, write_errors = await pending_write
+                    progress["inserted"] += inserted
+                    progress["updated"] += updated
+                    record_errors(write_errors)
+                    notify_leads_changed("/leads/import")
+                    yield sse_event({"type": "progress", **progress})
+                    pending_write = None
+                if chunk is None:
+                    break
+                valid, chunk_errors = chunk
+                progress["rows"] += len(valid) + len(chunk_errors)
+                record_errors(chunk_errors)
+                if valid:
+                    pending_write = asyncio.ensure_future(write_import_chunk(valid))
+                else:
+                    yield sse_event({"type": "progress", **progress})
+            yield sse_event({"type": "done", **progress, "errors": errors, "errors_truncated": progress["failed"] > len(errors)})
+        except Exception as e:
+            yield sse_event({"type": "error", "message": str(e), **progress})
+        finally:
+            stream.close()
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# 🧵 Background extraction jobs, stored in MongoDB so they survive a restart
+EXTRACT_JOB_WORKERS = int(os.getenv("EXTRACT_JOB_WORKERS", "2"))
+EXTRACT_JOB_MAX_ATTEMPTS = int(os.getenv("EXTRACT_JOB_MAX_ATTEMPTS", "3"))
+EXTRACT_JOB_BACKOFF = float(os.getenv("EXTRACT_JOB_BACKOFF", "5"))
+# Finished jobs are removed by a TTL index after this many seconds
+EXTRACT_JOB_RETENTION = int(os.getenv("EXTRACT_JOB_RETENTION", str(7 * 24 * 3600)))
+# A running job whose worker disappeared is retried after its lease runs out.
+# Live workers renew the lease every third of it, so it only has to cover a stalled heartbeat.
+EXTRACT_JOB_LEASE = GEMINI_TIMEOUT * 2 + 30
+EXTRACT_JOB_POLL_INTERVAL = 2.0
+JOB_FINAL_STATES = ("done", "failed")
+extract_job_wakeup = asyncio.Event()
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+def job_view(job):
+    return {
+        "job_id": job["_id"],
+        "status": job["status"],
+        "stage": job.get("stage"),
+        "filename": job.get("filename"),
+        "attempts": job.get("attempts", 0),
+        "result": job.get("result"),
+        "error": job.get("error"),
+        "createdAt": job.get("createdAt"),
+        "updatedAt": job.get("updatedAt"),
+    }
+
+async def claim_extract_job():
+    now = utcnow()
+    return await extract_jobs_collection.find_one_and_update(
+        {"$or": [
+            {"status": "queued", "runAt": {"$lte": now}},
+            {"status": "running", "leaseUntil": {"$lt": now}},
+        ]},
+        {
+            "$set": {"status": "running", "stage": "extracting", "updatedAt": now, "leaseId": uuid.uuid4().hex,
+                     "leaseUntil": now + datetime.timedelta(seconds=EXTRACT_JOB_LEASE)},
+            "$inc": {"attempts": 1},
+        },
+        sort=[("runAt", ASCENDING)],
+        return_document=ReturnDocument.AFTER,
     )
+
+async def run_extract_job(job):
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as stream:
+        await upload_bucket.download_to_stream(job["fileId"], stream)
+        extracted_data, cached = await cached_extract_lead(stream, job.get("contentType"))
+    await extract_jobs_collection.update_one({"_id": job["_id"]}, {"$set": {"stage": "saving", "updatedAt": utcnow()}})
+    lead_id, created = await upsert_lead(extracted_data)
+    notify_leads_changed("/extract/jobs")
+    return {"id": lead_id, "created": created, "cached": cached, "lead": extracted_data}
+
+async def renew_extract_job_lease(job, running):
+    # Keeps the lease alive while the job runs, stops the run if another worker has taken it over
+    while True:
+        await asyncio.sleep(EXTRACT_JOB_LEASE / 3)
+        try:
+            result = await extract_jobs_collection.update_one(
+                {"_id": job["_id"], "leaseId": job["leaseId"]},
+                {"$set": {"leaseUntil": utcnow() + datetime.timedelta(seconds=EXTRACT_JOB_LEASE)}},
+            )
+        except PyMongoError as e:
+            print(f"⚠ Could not renew the lease of job {job['_id']}: {e}")
+            continue
+        if result.matched_count == 0:
+            print(f"⚠ Lease of job {job['_id']} was taken over, stopping this run")
+            running.cancel()
+            return
+
+async def finish_extract_job(job, update):
+    now = utcnow()
+    result = await extract_jobs_collection.update_one(
+        {"_id": job["_id"], "leaseId": job["leaseId"]},
+        {"$set": {**update, "updatedAt": now, "finishedAt": now}, "$unset": {"leaseUntil": "", "leaseId": "", "runAt": ""}},
+    )
+    if result.matched_count == 0:
+        # Another worker owns the job now and still needs the upload
+        return
     try:
-        response = model.generate_content([
-            {
-                "mime_type": file.content_type,
-                "data": image_bytes
-            },
-            prompt_message
+        await upload_bucket.delete(job["fileId"])
+    except Exception as e:
+        print(f"⚠ Could not delete upload of job {job['_id']}: {e}")
+
+async def extract_job_worker(worker_id):
+    while True:
+        try:
+            job = await claim_extract_job()
+        except PyMongoError as e:
+            print(f"⚠ Extract worker {worker_id} could not claim a job: {e}")
+            job = None
+        if job is None:
+            extract_job_wakeup.clear()
+            try:
+                await asyncio.wait_for(extract_job_wakeup.wait(), EXTRACT_JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        print(f"🧵 Worker {worker_id} running job {job['_id']} (attempt {job['attempts']})")
+        try:
+            await process_extract_job(job)
+        except asyncio.CancelledError:
+            raise
+        except PyMongoError as e:
+            # The job keeps its lease and is retried once it runs out
+            print(f"⚠ Extract worker {worker_id} could not record job {job['_id']}: {e}")
+
+async def process_extract_job(job):
+    running = asyncio.create_task(run_extract_job(job))
+    heartbeat = asyncio.create_task(renew_extract_job_lease(job, running))
+    try:
+        result = await running
+    except asyncio.CancelledError:
+        if heartbeat.done() and not heartbeat.cancelled():
+            # Lease lost, the worker that took over finishes the job
+            return
+        raise
+    except MissingEmail as e:
+        # Extraction results are cached, a retry would hit the same lead
+        await finish_extract_job(job, {"status": "failed", "stage": "failed", "error": str(e)})
+        return
+    except Exception as e:
+        if job["attempts"] >= EXTRACT_JOB_MAX_ATTEMPTS:
+            print(f"❌ Job {job['_id']} failed: {e}")
+            await finish_extract_job(job, {"status": "failed", "stage": "failed", "error": str(e)})
+        else:
+            # Exponential backoff with jitter
+            delay = EXTRACT_JOB_BACKOFF * 2 ** (job["attempts"] - 1) * random.uniform(0.8, 1.2)
+            await extract_jobs_collection.update_one(
+                {"_id": job["_id"], "leaseId": job["leaseId"]},
+                {"$set": {"status": "queued", "stage": "retrying", "error": str(e), "updatedAt": utcnow(),
+                          "runAt": utcnow() + datetime.timedelta(seconds=delay)},
+                 "$unset": {"leaseUntil": "", "leaseId": ""}},
+            )
+        return
+    finally:
+        heartbeat.cancel()
+    await finish_extract_job(job, {"status": "done", "stage": "done", "result": result, "error": None})
+
+async def ensure_extract_job_indexes():
+    try:
+        await extract_jobs_collection.create_indexes([
+            IndexModel([("status", ASCENDING), ("runAt", ASCENDING)], name="status_1_runAt_1"),
+            IndexModel([("finishedAt", ASCENDING)], name="finishedAt_ttl", expireAfterSeconds=EXTRACT_JOB_RETENTION),
         ])
-        response = response.text
-        lines = response.strip("`").splitlines()
-        output = "\n".join(lines[1:])
-        json_output_str = output
-        print(json_output_str)
-        extracted_data = json.loads(json_output_str)
-        
-        # Add source and save to database
-        extracted_data["source"] = "Document"
-        result = await leads_collection.insert_one(extracted_data)
-        
-        return JSONResponse(content={"message": "Lead extracted and saved successfully", "id": str(result.inserted_id)})
+    except PyMongoError as e:
+        print(f"⚠ Could not create extract job indexes: {e}")
+
+def start_extract_job_workers():
+    return [asyncio.create_task(extract_job_worker(worker_id)) for worker_id in range(EXTRACT_JOB_WORKERS)]
+
+@app.post("/extract/jobs", status_code=202)
+async def submit_extract_job(file: UploadFile = File(...)):
+    check_upload_size(file)
+    try:
+        job_id = uuid.uuid4().hex
+        file.file.seek(0)
+        file_id = await upload_bucket.upload_from_stream(
+            file.filename or job_id, file.file, metadata={"contentType": file.content_type, "jobId": job_id}
+        )
+        now = utcnow()
+        await extract_jobs_collection.insert_one({
+            "_id": job_id,
+            "status": "queued",
+            "stage": "queued",
+            "filename": file.filename,
+            "contentType": file.content_type,
+            "fileId": file_id,
+            "attempts": 0,
+            "createdAt": now,
+            "updatedAt": now,
+            "runAt": now,
+        })
+        extract_job_wakeup.set()
+        return JSONResponse(content={"job_id": job_id, "status": "queued"}, status_code=202)
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
+@app.get("/extract/jobs/{job_id}")
+async def get_extract_job(job_id: str):
+    job = await extract_jobs_collection.find_one({"_id": job_id})
+    if job is None:
+        return JSONResponse(content={"error": "Job not found"}, status_code=404)
+    return JSONResponse(content=json.loads(json.dumps(job_view(job), default=str)))
+
+@app.get("/extract/jobs/{job_id}/events")
+async def extract_job_events(request: Request, job_id: str):
+    async def event_source():
+        last = None
+        while not await request.is_disconnected():
+            job = await extract_jobs_collection.find_one({"_id": job_id})
+            if job is None:
+                yield sse_event({"type": "error", "message": "Job not found"})
+                return
+            view = job_view(job)
+            if (view["status"], view["stage"], view["attempts"]) != last:
+                last = (view["status"], view["stage"], view["attempts"])
+                yield sse_event({"type": "job", **view})
+            if view["status"] in JOB_FINAL_STATES:
+                return
+            await asyncio.sleep(1)
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# 🧺 Optional micro-batching of /save_lead inserts into one insert_many
+SAVE_LEAD_COALESCE = os.getenv("SAVE_LEAD_COALESCE", "false").lower() in ("1", "true", "yes")
+SAVE_LEAD_BATCH_WINDOW_MS = float(os.getenv("SAVE_LEAD_BATCH_WINDOW_MS", "5"))
+SAVE_LEAD_BATCH_SIZE = int(os.getenv("SAVE_LEAD_BATCH_SIZE", "100"))
+
+class WriteCoalescer:
+    # Collects inserts for up to window_ms or max_size documents, each caller still gets its own id or error
+    def __init__(self, collection, window_ms, max_size):
+        self.collection = collection
+        self.window = window_ms / 1000
+        self.max_size = max_size
+        self.pending = []
+        self.timer = None
+        self.flushes = set()
+        self.stats = {"flushes": 0, "documents": 0, "max_flush_size": 0, "wait_ms": 0.0, "max_wait_ms": 0.0, "flush_ms": 0.0}
+
+    async def insert(self, document):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((document, future, time.perf_counter()))
+        if len(self.pending) >= self.max_size:
+            self.start_flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.window, self.start_flush)
+        return await future
+
+    def start_flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.create_task(self.flush(batch))
+            self.flushes.add(task)
+            task.add_done_callback(self.flushes.discard)
+
+    async def flush(self, batch):
+        started = time.perf_counter()
+        waits = [(started - enqueued) * 1000 for _, _, enqueued in batch]
+        documents = [document for document, _, _ in batch]
+        write_errors = {}
+        try:
+            await self.collection.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            write_errors = {error["index"]: error["errmsg"] for error in e.details.get("writeErrors", [])}
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        # insert_many sets _id on every document
+        for index, (document, future, _) in enumerate(batch):
+            if future.done():
+                continue
+            if index in write_errors:
+                future.set_exception(PyMongoError(write_errors[index]))
+            else:
+                future.set_result(document["_id"])
+        if len(write_errors) < len(batch):
+            notify_leads_changed("/save_lead")
+
+        self.stats["flushes"] += 1
+        self.stats["documents"] += len(batch)
+        self.stats["max_flush_size"] = max(self.stats["max_flush_size"], len(batch))
+        self.stats["wait_ms"] += sum(waits)
+        self.stats["max_wait_ms"] = max(self.stats["max_wait_ms"], max(waits))
+        self.stats["flush_ms"] += (time.perf_counter() - started) * 1000
+
+    async def drain(self):
+        self.start_flush()
+        if self.flushes:
+            await asyncio.gather(*self.flushes, return_exceptions=True)
+
+    def snapshot(self):
+        flushes, documents = self.stats["flushes"], self.stats["documents"]
+        return {
+            **self.stats,
+            "window_ms": self.window * 1000,
+            "max_size": self.max_size,
+            "avg_flush_size": documents / flushes if flushes else 0.0,
+            # Latency added to each request by waiting for its batch
+            "avg_wait_ms": self.stats["wait_ms"] / documents if documents else 0.0,
+        }
+
+save_lead_coalescer = WriteCoalescer(leads_collection, SAVE_LEAD_BATCH_WINDOW_MS, SAVE_LEAD_BATCH_SIZE) if SAVE_LEAD_COALESCE else None
+
 @app.post("/save_lead")
-async def save_lead(lead: LeadData):
+async def save_lead(request: Request, lead: LeadData):
+    lead_dict = lead.dict()
+    fingerprint = hashlib.sha256(json.dumps(lead_dict, sort_keys=True).encode()).hexdigest()
+    return await idempotent(request, "/save_lead", lambda: insert_lead(lead_dict), fingerprint)
+
+async def insert_lead(lead_dict):
     try:
-        lead_dict = lead.dict()
-        result = await leads_collection.insert_one(lead_dict)
-        return JSONResponse(content={"message": "Lead saved successfully", "id": str(result.inserted_id)})
+        if save_lead_coalescer is not None:
+            inserted_id = await save_lead_coalescer.insert(lead_dict)
+        else:
+            result = await leads_collection.insert_one(lead_dict)
+            inserted_id = result.inserted_id
+            notify_leads_changed("/save_lead")
+        return JSONResponse(content={"message": "Lead saved successfully", "id": str(inserted_id)})
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
@@ -372,23 +2381,50 @@ async def update_graph(data: GraphUpdate):
     print("Entry:", ENTRY)
     return {"status": "Graph updated"}
 
+# 🧩 Compiled graphs are cached by a hash of the definition, so /run only compiles after /update-graph changes it
+graph_cache = LRUCache(maxsize=8)
+graph_cache_stats = {"hits": 0, "misses": 0, "compile_ms": 0.0, "last_compile_ms": 0.0}
+
+def graph_key():
+    definition = {
+        "nodes": [[node_id, fn.__name__] for node_id, fn in NODES.items()],
+        "edges": [list(edge) for edge in EDGES],
+        "entry": ENTRY,
+    }
+    return hashlib.sha256(json.dumps(definition).encode()).hexdigest()
+
+def compiled_graph():
+    key = graph_key()
+    runnable = graph_cache.get(key)
+    if runnable is not None:
+        graph_cache_stats["hits"] += 1
+        return runnable
+    graph_cache_stats["misses"] += 1
+    started = time.perf_counter()
+    graph = StateGraph(WorkflowState)
+    for node_id, fn in NODES.items():
+        graph.add_node(node_id, fn)
+    for source, target in EDGES:
+        graph.add_edge(source, target)
+    graph.set_entry_point(ENTRY)
+    if NODES:
+        graph.add_edge(list(NODES.keys())[-1], END)
+    print("✅ Final nodes:", list(NODES.keys()))
+    print("✅ Final edges:", EDGES)
+    runnable = graph.compile()
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    graph_cache_stats["compile_ms"] += elapsed_ms
+    graph_cache_stats["last_compile_ms"] = elapsed_ms
+    graph_cache[key] = runnable
+    return runnable
+
 @app.post("/run")
 async def run_graph():
     try:
         if "lead" not in NODES:
             print("⚠ lead not found in NODES, injecting default...")
             NODES["lead"] = lead_tool
-        graph = StateGraph(WorkflowState)
-        for node_id, fn in NODES.items():
-            graph.add_node(node_id, fn)
-        for source, target in EDGES:
-            graph.add_edge(source, target)
-        graph.set_entry_point(ENTRY)
-        if NODES:
-            graph.add_edge(list(NODES.keys())[-1], END)
-        print("✅ Final nodes:", list(NODES.keys()))
-        print("✅ Final edges:", EDGES)
-        runnable = graph.compile()
+        runnable = compiled_graph()
         # Run the workflow asynchronously
         result = await runnable.ainvoke({"email": "", "whatsapp": ""})
         return {"status": "executed", "log": "done", "output": result}
@@ -398,7 +2434,7 @@ async def run_graph():
 
 @app.post("/ask")
 async def ask_user(input: PromptInput):
-    result = process_prompt(input.user_input, input.lead_data)
+    result = await answer_prompt(input.user_input, input.lead_data, input.llm_summary)
     # Always return a dict with a 'message' property
     if isinstance(result, str):
         return {"result": {"message": result}}
@@ -406,3 +2442,86 @@ async def ask_user(input: PromptInput):
         return {"result": result}
     else:
         return {"result": {"message": str(result)}}
+
+def sse_event(event):
+    return f"data: {json.dumps(event, default=str)}\n\n"
+
+@app.post("/ask/stream")
+async def ask_user_stream(input: PromptInput):
+    async def event_source():
+        try:
+            async for event in answer_prompt_stream(input.user_input, input.lead_data, input.llm_summary):
+                yield sse_event(event)
+        except Exception as e:
+            yield sse_event({"type": "error", "message": str(e)})
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.websocket("/ws/ask")
+async def ask_user_ws(websocket: WebSocket):
+    await websocket.accept()
+    try:
+        while True:
+            # One PromptInput JSON object per question, answered as a stream of events
+            try:
+                input = PromptInput.model_validate(await websocket.receive_json())
+            except (json.JSONDecodeError, ValidationError) as e:
+                await websocket.send_json({"type": "error", "message": f"Invalid request: {e}"})
+                continue
+            try:
+                async for event in answer_prompt_stream(input.user_input, input.lead_data, input.llm_summary):
+                    await websocket.send_json(json.loads(json.dumps(event, default=str)))
+            except Exception as e:
+                await websocket.send_json({"type": "error", "message": str(e)})
+    except WebSocketDisconnect:
+        print("🔌 Chat WebSocket disconnected")
+
+def image_preprocessing_snapshot():
+    return {
+        **image_stats,
+        "enabled": Image is not None,
+        "bytes_saved": image_stats["bytes_in"] - image_stats["bytes_out"],
+        "avg_preprocess_ms": image_stats["preprocess_ms"] / image_stats["images"] if image_stats["images"] else 0.0,
+        "avg_gemini_ms": image_stats["gemini_ms"] / image_stats["gemini_calls"] if image_stats["gemini_calls"] else 0.0,
+    }
+
+def extraction_parse_snapshot():
+    parsed = extraction_parse_stats["ok"] + extraction_parse_stats["repaired"]
+    attempts = parsed + extraction_parse_stats["retried"] + extraction_parse_stats["failed"]
+    return {
+        **extraction_parse_stats,
+        "failure_rate": (attempts - extraction_parse_stats["ok"]) / attempts if attempts else 0.0,
+    }
+
+@app.get("/metrics")
+async def get_metrics():
+    return {
+        "mongo_pool": pool_metrics.snapshot(),
+        "answer_cache": answer_cache_snapshot(),
+        "query_cache": {**query_cache_stats, "size": len(query_cache)},
+        "extraction_cache": {**extraction_cache_stats, "size": len(extraction_cache)},
+        "local_extraction": {**local_extract_stats, "pdf_support": PdfReader is not None},
+        "image_preprocessing": image_preprocessing_snapshot(),
+        "extraction_parsing": extraction_parse_snapshot(),
+        "save_lead_coalescer": save_lead_coalescer.snapshot() if save_lead_coalescer is not None else {"enabled": False},
+        "workflow_graphs": {**graph_cache_stats, "size": len(graph_cache)},
+    }
+
+@app.get("/indexes")
+async def get_indexes():
+    try:
+        return await index_report()
+    except PyMongoError as e:
+        return JSONResponse(content={**index_status, "error": str(e)}, status_code=500)
+
+@app.get("/query-stats")
+async def get_query_stats(limit: int = 10):
+    return {
+        "sample_rate": EXPLAIN_SAMPLE_RATE,
+        "shapes": len(query_shapes),
+        "worst": worst_query_shapes(limit),
+    }
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# new.py reads these at import time; the clients it creates connect lazily
+os.environ.setdefault("MONGO_DETAILS", "mongodb://localhost:27017")
+os.environ.setdefault("GEMINI_API_KEY", "test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,24 @@
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+from new import flatten_image
+
+
+def test_transparent_areas_become_white():
+    image = Image.new("RGBA", (4, 4), (0, 0, 0, 0))
+    image.putpixel((0, 0), (0, 0, 0, 255))
+    flattened = flatten_image(image)
+    assert flattened.mode == "RGB"
+    assert flattened.getpixel((1, 1)) == (255, 255, 255)
+    assert flattened.getpixel((0, 0)) == (0, 0, 0)
+
+
+def test_palette_transparency_becomes_white():
+    image = Image.new("P", (2, 2), 0)
+    image.info["transparency"] = 0
+    assert flatten_image(image).getpixel((0, 0)) == (255, 255, 255)
+
+
+def test_opaque_images_are_converted_unchanged():
+    assert flatten_image(Image.new("L", (2, 2), 7)).getpixel((0, 0)) == (7, 7, 7)
@@ -0,0 +1,21 @@
+import pytest
+
+from new import MissingEmail, lead_upsert_spec
+
+
+def test_upsert_is_keyed_on_normalized_email():
+    email, update = lead_upsert_spec({"name": "John Smith", "email": " John@Acme.com ", "phone": "", "source": "Document"})
+    assert email == "john@acme.com"
+    assert update["$set"] == {"name": "John Smith", "email": "john@acme.com"}
+    assert update["$setOnInsert"]["source"] == "Document"
+    assert update["$setOnInsert"]["status"] == "New"
+
+
+@pytest.mark.parametrize("document", [
+    {"name": "John Smith", "email": "", "phone": "+14155550100"},
+    {"name": "John Smith", "email": "   "},
+    {"name": "John Smith"},
+])
+def test_lead_without_email_is_rejected(document):
+    with pytest.raises(MissingEmail):
+        lead_upsert_spec(document)
@@ -0,0 +1,24 @@
+from new import LOCAL_EXTRACT_MIN_CONFIDENCE, local_extract
+
+
+def test_single_name_line_is_confident():
+    lead, confidence = local_extract("John Smith\njohn@acme.com\n+1 415 555 0100")
+    assert lead == {"name": "John Smith", "email": "john@acme.com", "phone": "+14155550100"}
+    assert confidence >= LOCAL_EXTRACT_MIN_CONFIDENCE
+
+
+def test_labelled_name_is_confident():
+    lead, confidence = local_extract("Acme Widgets Inc\nName: John Smith\njohn@acme.com\n+1 415 555 0100")
+    assert lead["name"] == "John Smith"
+    assert confidence >= LOCAL_EXTRACT_MIN_CONFIDENCE
+
+
+def test_several_name_lines_fall_back_to_gemini():
+    _, confidence = local_extract("Acme Widgets Inc\nJohn Smith\njohn@acme.com\n+1 415 555 0100")
+    assert confidence < LOCAL_EXTRACT_MIN_CONFIDENCE
+
+
+def test_name_from_email_falls_back_to_gemini():
+    lead, confidence = local_extract("john.smith@acme.com\n+1 415 555 0100")
+    assert lead["name"] == "John Smith"
+    assert confidence < LOCAL_EXTRACT_MIN_CONFIDENCE
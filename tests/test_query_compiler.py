@@ -0,0 +1,74 @@
+import datetime
+
+import pytest
+
+from new import CASE_INSENSITIVE_COLLATION, QueryError, compile_query
+
+
+def test_unanchored_name_regex_is_not_narrowed():
+    compiled, collation = compile_query({"name": {"$regex": "Kumar", "$options": "i"}})
+    assert compiled == {"name": {"$options": "i", "$regex": "kumar"}}
+    assert collation is None
+
+
+def test_prefix_name_regex_is_kept():
+    compiled, collation = compile_query({"name": {"$regex": "^Raj", "$options": "i"}})
+    assert compiled == {"name": {"$options": "i", "$regex": "^raj"}}
+    assert collation is None
+
+
+def test_exact_name_match_uses_collation():
+    compiled, collation = compile_query({"name": {"$regex": "^Akshaj$", "$options": "i"}})
+    assert compiled == {"name": "akshaj"}
+    assert collation == CASE_INSENSITIVE_COLLATION
+
+
+def test_exact_name_match_with_non_string_predicates_uses_collation():
+    query = {
+        "name": {"$regex": "^Akshaj$", "$options": "i"},
+        "email": {"$exists": True},
+        "createdAt": {"$gte": "2025-07-01T00:00:00"},
+    }
+    compiled, collation = compile_query(query)
+    assert compiled["name"] == "akshaj"
+    assert collation == CASE_INSENSITIVE_COLLATION
+
+
+def test_exact_name_match_next_to_string_equality_keeps_simple_collation():
+    compiled, collation = compile_query({"name": {"$regex": "^Akshaj$", "$options": "i"}, "status": "New"})
+    assert compiled == {"name": {"$options": "i", "$regex": "^akshaj$"}, "status": "New"}
+    assert collation is None
+
+
+def test_string_predicate_inside_or_keeps_simple_collation():
+    query = {"$or": [{"name": {"$regex": "^Akshaj$", "$options": "i"}}, {"source": {"$in": ["csv", "web"]}}]}
+    compiled, collation = compile_query(query)
+    assert {"name": {"$options": "i", "$regex": "^akshaj$"}} in compiled["$or"]
+    assert collation is None
+
+
+def test_case_sensitive_regex_is_unchanged():
+    compiled, collation = compile_query({"name": {"$regex": "^Ak"}})
+    assert compiled == {"name": {"$regex": "^Ak"}}
+    assert collation is None
+
+
+def test_bare_day_becomes_range():
+    compiled, _ = compile_query({"createdAt": "2025-07-01"})
+    assert compiled["createdAt"] == {
+        "$gte": datetime.datetime(2025, 7, 1),
+        "$lt": datetime.datetime(2025, 7, 2),
+    }
+
+
+@pytest.mark.parametrize("query", [
+    {"password": "x"},
+    {"name": {"$where": "1"}},
+    {"$where": "1"},
+    {"status": ["New", "Won"]},
+    {"createdAt": {"$regex": "2025"}},
+    {"$or": []},
+])
+def test_invalid_queries_raise(query):
+    with pytest.raises(QueryError):
+        compile_query(query)